@@ -3,18 +3,12 @@
 # واتساب (فردي/جماعي) + حذف جماعي + Import من Excel/CSV
 # + سجل الإشعارات (Notifications_Log)
 
-import json
-import time
-import uuid
-import urllib.parse
-from datetime import datetime, date, timedelta
 import os
 
-import pandas as pd
 import streamlit as st
-import gspread
-import gspread.exceptions as gse
-from google.oauth2.service_account import Credentials
+
+from attendance_schema import DEFAULT_BRANCHES
+
 
 # ================== إعداد الصفحة ==================
 st.set_page_config(page_title="AttendanceHub - Mega Formation", layout="wide")
@@ -30,11 +24,134 @@ st.markdown(
     unsafe_allow_html=True,
 )
 
+# ================== الفروع + كلمة السرّ (بلا pandas و لا Google) ==================
+# الفروع تتقرا من secrets: [branches] "Tunis" = "TN" (وإلا DEFAULT_BRANCHES)
+def load_branches() -> dict[str, str]:
+    try:
+        if "branches" in st.secrets:
+            return {str(k): str(v) for k, v in dict(st.secrets["branches"]).items()}
+    except Exception:
+        pass
+    return dict(DEFAULT_BRANCHES)
+
+
+BRANCHES = load_branches()
+
+
+def branch_code(branch: str) -> str:
+    return BRANCHES.get(branch, branch)
+
+
+def branch_password(branch: str) -> str:
+    try:
+        m = st.secrets["branch_passwords"]
+        return str(m.get(branch_code(branch), ""))
+    except Exception:
+        pass
+    return ""
+
+
+# ================== Sidebar: اختيار الفرع + المودباس ==================
+st.sidebar.markdown("## ⚙️ إعدادات الفرع")
+
+branch = st.sidebar.selectbox("اختر الفرع", list(BRANCHES.keys()))
+
+pw_need = branch_password(branch)
+key_pw = f"branch_pw_ok::{branch}"
+
+if pw_need:
+    if key_pw not in st.session_state:
+        st.session_state[key_pw] = False
+    if not st.session_state[key_pw]:
+        pw_try = st.sidebar.text_input("🔐 كلمة سرّ الفرع", type="password")
+        if st.sidebar.button("دخول الفرع"):
+            if pw_try == pw_need:
+                st.session_state[key_pw] = True
+                st.sidebar.success("تم الدخول ✅")
+            else:
+                st.sidebar.error("كلمة سرّ غير صحيحة ❌")
+        st.stop()
+else:
+    st.sidebar.warning("⚠️ لم يتم ضبط كلمة المرور لهذا الفرع في secrets.branch_passwords")
+
+# ================== المكتبات الثقال (بعد الدخول) ==================
+# شاشة الدخول تتعرض بلا pandas / gspread / Google: ما نحمّلوهم كان بعد ما المودباس يتأكّد
+import hashlib
+import json
+import pathlib
+import time
+import uuid
+import threading
+from datetime import datetime, date, timedelta
+
+import pandas as pd
+import requests
+import gspread
+import gspread.exceptions as gse
+import google.auth.exceptions
+from google.oauth2.service_account import Credentials
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+from attendance_engine import (
+    ABSENCES_COLS,
+    ABSENCES_SHEET,
+    ACADEMIC_YEAR_START_MONTH,
+    DUP_FLAG,
+    EXPORT_FORMATS,
+    Instrumented,
+    Metrics,
+    NOTIF_LOG_COLS,
+    RISK_LABELS,
+    ReportCache,
+    ROSTER_REQUIRED_COLS,
+    RollupCube,
+    NOTIF_LOG_SHEET,
+    SUBJECTS_COLS,
+    SUBJECTS_SHEET,
+    TRAINEES_COLS,
+    TRAINEES_SHEET,
+    IMPORT_MAX_REJECT_ROWS,
+    IMPORT_REQUIRED_COLS,
+    absence_keys,
+    absences_to_justify,
+    apply_duplicate_policy,
+    apply_justification_delta,
+    as_float,
+    breach_projection,
+    build_whatsapp_message_for_trainee,
+    compact_absences,
+    current_academic_year,
+    exceedance_message,
+    exceedances,
+    export_chunks,
+    hours_col,
+    in_current_year,
+    iter_upload_chunks,
+    memory_report,
+    normalize_phone,
+    notifications_index,
+    prepare_roster,
+    sheet_title,
+    slice_sent_at,
+    trainee_fingerprints,
+    unjustified_totals,
+    validate_absence_chunk,
+    values_to_df,
+    wa_link,
+    write_export,
+)
+
 # ================== إعداد Google Sheets ==================
 SCOPE = ["https://www.googleapis.com/auth/spreadsheets"]
 
 
 def make_client_and_sheet_id():
+    # 0) backend محلي في الذاكرة (تجارب / loadtest.py): ATTENDANCEHUB_BACKEND=local
+    if os.environ.get("ATTENDANCEHUB_BACKEND") == "local":
+        from local_sheets import LOCAL_SHEET_ID, LocalClient
+
+        return LocalClient(), LOCAL_SHEET_ID
+
     # 1) نخدم من Streamlit secrets (بيئة الكلاود)
     if "gcp_service_account" in st.secrets:
         try:
@@ -74,38 +191,30 @@ def make_client_and_sheet_id():
         st.stop()
 
 
-client, SPREADSHEET_ID = make_client_and_sheet_id()
+# ============= Instrumentation: calls متاع Sheets + توقيت الأقسام =============
+@st.cache_resource
+def metrics() -> Metrics:
+    return Metrics()
+
+
+def session_id():
+    ctx = get_script_run_ctx(suppress_warning=True)
+    return ctx.session_id if ctx else None
+
 
-# أسماء الشيتات
-TRAINEES_SHEET = "Trainees"
-SUBJECTS_SHEET = "Subjects"
-ABSENCES_SHEET = "Absences"
-NOTIF_LOG_SHEET = "Notifications_Log"
+def timed(name: str):
+    return metrics().section(name, session_id())
 
-TRAINEES_COLS = ["id", "nom", "telephone", "tel_parent", "branche", "specialite", "date_debut", "actif"]
 
-SUBJECTS_COLS = [
-    "id",
-    "nom_matiere",
-    "branche",
-    "specialites",  # قائمة تخصّصات مفصولة بفاصلة
-    "heures_totales",
-    "heures_semaine",
-]
+@st.cache_resource
+def sheets_client():
+    # التوثيق (service account + gspread.authorize) مرة وحدة للـprocess، موش مع كل rerun.
+    # كل call يعدّي من الـclient (open_by_key ⇒ worksheet ⇒ get_all_values ...) يتحسب
+    client, sheet_id = make_client_and_sheet_id()
+    return Instrumented(client, metrics(), session=session_id), sheet_id
 
-ABSENCES_COLS = ["id", "trainee_id", "subject_id", "date", "heures_absence", "justifie", "commentaire"]
 
-NOTIF_LOG_COLS = [
-    "id",
-    "trainee_id",
-    "phone",
-    "target",       # Trainee / Parent
-    "branche",
-    "period_from",
-    "period_to",
-    "period_label",
-    "sent_at_iso",  # تاريخ ووقت الإرسال (UTC ISO)
-]
+client, SPREADSHEET_ID = sheets_client()
 
 # ============= Utils Sheets =============
 
@@ -126,13 +235,184 @@ def get_spreadsheet():
     raise last_err
 
 
-def ensure_ws(title: str, columns: list[str]):
+def branch_sheet(base: str, branch: str) -> str:
+    return sheet_title(base, branch_code(branch))
+
+
+# نسخة (version) لكل شيت: تزيد مع كل كتابة ⇒ الحسابات المشتقّة تتكاشّا حسب النسخة
+@st.cache_resource
+def data_versions() -> dict:
+    return {}
+
+
+REFRESH_EPOCH = "__refresh__"  # مفتاح في data_versions: يزيد مع زر "تحديث الداتا"
+
+
+def refresh_epoch() -> tuple:
+    # (زر التحديث، فترة LOADER_MAX_AGE) ⇒ تبديلات يدوية في Google Sheets تبدّل حتى الكاشات
+    # المشتقّة (cache_resource، export في الديسك) موش كان الـloaders
+    return data_versions().get(REFRESH_EPOCH, 0), int(time.time() // LOADER_MAX_AGE)
+
+
+def bump_refresh_epoch():
+    versions = data_versions()
+    versions[REFRESH_EPOCH] = versions.get(REFRESH_EPOCH, 0) + 1
+
+
+def data_version(title: str) -> tuple:
+    # (نسخة محلية، epoch، token من _Meta) ⇒ الكتابات من سرفر آخر زادة تبدّل النسخة
+    return data_versions().get(title, 0), refresh_epoch(), meta_token(title)
+
+
+def mark_changed(title: str):
+    # الكاشات الكل مربوطة بالنسخة ⇒ يتعاود يتقرا كان الشيت اللي تبدّل (موش الكاش كامل).
+    # _Meta تتكتب مرة وحدة في آخر الـrun (flush_meta) موش مع كل كتابة
+    with snapshot_state()["lock"]:  # نفس الـlock متاع التحديث في الخلفية
+        versions = data_versions()
+        versions[title] = versions.get(title, 0) + 1
+    state = meta_state()
+    with state["lock"]:
+        state["dirty"].add(title)
+
+
+# ============= كشف التبديلات (_Meta) =============
+# كل كتابة من التطبيق تحط token جديد للشيت في _Meta (سطر لكل شيت).
+# _Meta يتقرا في الخلفية (call وحدة صغيرة كل META_TTL_SECONDS، الـrender ما يستنّاش Google)
+# و الـloaders ما يعاودو يجيبو الشيت كامل كان كي الـtoken متاعو يتبدّل ⇒ كي ما تبدّل شي،
+# الكاش يقعد حتى LOADER_MAX_AGE.
+META_SHEET = "_Meta"
+META_COLS = ["id", "version", "modified_at"]  # id = اسم الشيت
+META_TTL_SECONDS = 30
+LOADER_MAX_AGE = 3600  # تبديلات يدوية في Google Sheets (بلا التطبيق) تبان بعد ساعة على الأكثر
+
+
+def meta_versions() -> dict:
+    # آخر tokens تقراو (read-only)؛ كي يفوت META_TTL_SECONDS نعاودو نقراو في الخلفية
+    state = meta_state()
+    with state["lock"]:
+        stale = not state["reading"] and time.time() - state["read_at"] > META_TTL_SECONDS
+        if stale and not is_read_only():
+            state["reading"] = True
+        else:
+            stale = False
+    if stale:
+        threading.Thread(target=read_meta, name="meta-refresh", daemon=True).start()
+    return state["tokens"]
+
+
+def read_meta():
+    # thread بلا session_state ⇒ client مباشرة (بلا retries و st.error متاع get_spreadsheet)
+    state = meta_state()
+    tokens = None
+    try:
+        vals = client.open_by_key(SPREADSHEET_ID).worksheet(META_SHEET).get_all_values()
+        tokens = {}
+        for r in vals[1:]:
+            if len(r) > 1 and r[0]:
+                # سطرين لنفس الشيت (append من زوز سرفرات في نفس الوقت) ⇒ نجمعو الـtokens
+                tokens[r[0]] = tokens.get(r[0], "") + r[1]
+    except gspread.WorksheetNotFound:
+        tokens = {}
+    except BACKEND_ERRORS:
+        pass  # نخليو الـtokens القدام؛ الـloaders هوما اللي يقرّرو offline
+    with state["lock"]:
+        state["reading"] = False
+        state["read_at"] = time.time()
+        if tokens is not None:
+            if state["baseline"] is None:
+                state["baseline"] = tokens
+            state["tokens"] = tokens
+
+
+def expire_meta():
+    meta_state()["read_at"] = 0.0
+
+
+@st.cache_resource
+def meta_worksheet():
+    return ensure_ws(META_SHEET, META_COLS)
+
+
+@st.cache_resource
+def meta_state() -> dict:
+    # مشتركة بين الجلسات: آخر tokens من _Meta (و أوّل قراية في الـprocess = baseline)،
+    # الشيتات اللي تبدّلت و ما تكتبتش في _Meta بعد، و الـtokens اللي كتبناهم
+    # (title -> (token جديد، token اللي كان قبلو))
+    return {
+        "lock": threading.Lock(),
+        "tokens": {},
+        "baseline": None,
+        "read_at": 0.0,
+        "reading": False,
+        "dirty": set(),
+        "written": {},
+    }
+
+
+def meta_token(title: str) -> str:
+    token = meta_versions().get(title, "")
+    state = meta_state()
+    # أوّل قراية بعد الـrestart ما تقول شي (الـsnapshot يتحدّث وحدو من Google) ⇒ "" كيما قبلها
+    if state["baseline"] is not None and state["baseline"].get(title) == token:
+        return ""
+    # token كتبناه أحنا = نفس الداتا اللي تقرات بعد الكتابة (النسخة المحلية تبدّلت) ⇒ ما نعاودوش نجيبو الشيت
+    own = state["written"].get(title)
+    return own[1] if own and own[0] == token else token
+
+
+def bump_meta(titles: list[str]) -> dict:
+    # سطور _Meta ما تتحذفش ⇒ رقم السطر ثابت: batch_update وحدة بلا تحقّق (locate_rows).
+    # حتى لو الـindex قديم و كتبنا على سطر شيت آخر، الـtokens متاع الزوز يتبدّلو ⇒ refetch زايد برك
+    ws = meta_worksheet()
+    now = datetime.now().isoformat(timespec="seconds")
+    ids = row_index(ws)["ids"]
+    tokens, updates, new = {}, [], []
+    for title in titles:
+        tokens[title] = uuid.uuid4().hex[:12]
+        row = [title, tokens[title], now]
+        if title in ids:
+            r = ids.index(title) + 2
+            updates.append({"range": f"A{r}:C{r}", "values": [row]})
+        else:
+            new.append(row)
+    if updates:
+        ws.batch_update(updates)
+    if new:
+        ws.append_rows(new)
+        note_appended(ws.title, [r[0] for r in new])
+    return tokens
+
+
+def flush_meta():
+    # مرة وحدة في الـrun (آخر السكريبت، ولا أولو كان الـrun اللي قبل وفى بـst.rerun/st.stop)
+    state = meta_state()
+    with state["lock"]:
+        titles, state["dirty"] = sorted(state["dirty"]), set()
+    if not titles:
+        return
+    try:
+        tokens = bump_meta(titles)
+    except (*BACKEND_ERRORS, gspread.WorksheetNotFound):
+        # الكتابات نفسها صارت؛ السرفرات الأخرى يشوفوها بعد LOADER_MAX_AGE
+        meta_worksheet.clear()
+        forget_rows(META_SHEET)
+        return
+    for title, token in tokens.items():
+        state["written"][title] = (token, meta_token(title))
+    expire_meta()
+
+
+def ensure_ws(title: str, columns: list[str], on_create=None):
     sh = get_spreadsheet()
     try:
         ws = sh.worksheet(title)
     except gspread.WorksheetNotFound:
         ws = sh.add_worksheet(title=title, rows="2000", cols=str(max(len(columns), 8)))
         ws.update("1:1", [columns])
+        if on_create is not None:
+            rows = on_create(sh)
+            if rows:
+                ws.append_rows(rows)
         return ws
     header = ws.row_values(1)
     if not header or header[: len(columns)] != columns:
@@ -140,80 +420,222 @@ def ensure_ws(title: str, columns: list[str]):
     return ws
 
 
-def append_record(sheet_name: str, cols: list[str], rec: dict):
-    ws = ensure_ws(sheet_name, cols)
-    row = [str(rec.get(c, "")) for c in cols]
-    ws.append_row(row)
-    st.cache_data.clear()
-
-
-def delete_record_by_id(sheet_name: str, cols: list[str], rec_id: str):
-    ws = ensure_ws(sheet_name, cols)
-    vals = ws.get_all_values()
+def legacy_records(sh, title: str) -> list[dict]:
+    try:
+        vals = sh.worksheet(title).get_all_values()
+    except gspread.WorksheetNotFound:
+        return []
     if not vals or len(vals) < 2:
-        return
+        return []
     header = vals[0]
-    id_idx = header.index("id") if "id" in header else 0
+    return [dict(zip(header, r)) for r in vals[1:]]
 
-    for i, r in enumerate(vals[1:], start=2):
-        if len(r) > id_idx and r[id_idx] == rec_id:
-            ws.delete_rows(i)
-            st.cache_data.clear()
-            break
 
+def legacy_branch_rows(sh, base: str, columns: list[str], branch: str) -> list[list[str]]:
+    """
+    أول مرة يتخلق شيت الفرع: ننقلو فيه السجلات متاع الفرع من الشيت القديم المشترك
+    (Absences ما فيهاش branche ⇒ نعتمدو على المتكوّنين متاع الفرع)
+    """
+    recs = legacy_records(sh, base)
+    if not recs:
+        return []
+    if "branche" in recs[0]:
+        keep = [r for r in recs if r.get("branche") == branch]
+    elif "trainee_id" in recs[0]:
+        tr_ids = {r.get("id") for r in legacy_records(sh, TRAINEES_SHEET) if r.get("branche") == branch}
+        keep = [r for r in recs if r.get("trainee_id") in tr_ids]
+    else:
+        return []
+    return [[str(r.get(c, "")) for c in columns] for r in keep]
+
+
+def ensure_branch_ws(base: str, columns: list[str], branch: str):
+    return ensure_ws(
+        branch_sheet(base, branch),
+        columns,
+        on_create=lambda sh: legacy_branch_rows(sh, base, columns, branch),
+    )
+
+
+# ============= عنونة السطور (optimistic concurrency) =============
+# نحفظو عمود الـid متاع كل شيت في الذاكرة (مشترك بين الجلسات) باش نلقاو رقم السطر بلا
+# get_all_values. قبل كل كتابة نتأكّدو اللي السطر مازال فيه نفس الـid (قراية خانات الـid
+# وحدها)، و كان حد آخر زاد/حذف سطور في الوسط نعاودو نقراو عمود الـid و نعاودو.
+WRITE_RETRIES = 3
+VERIFY_MAX_CELLS = 50  # أكثر من هكّا: نقراو عمود الـid كامل (call وحدة) عوض خانة بخانة
+
+
+class WriteConflictError(RuntimeError):
+    pass
+
+
+@st.cache_resource
+def row_indexes() -> dict:
+    # title -> {"header": [...], "id_col": n, "ids": (id السطر 2, id السطر 3, ...)}
+    return {}
+
+
+def row_index(ws, refresh: bool = False) -> dict:
+    idx = row_indexes().get(ws.title)
+    if idx is None or refresh:
+        header = ws.row_values(1)
+        id_col = header.index("id") + 1 if "id" in header else 1
+        idx = {"header": header, "id_col": id_col, "ids": tuple(ws.col_values(id_col)[1:])}
+        row_indexes()[ws.title] = idx
+    return idx
+
+
+def forget_rows(title: str):
+    row_indexes().pop(title, None)
+
+
+def note_appended(title: str, ids):
+    # السطور الجديدة في آخر الشيت (كان حد آخر زاد قبلنا، verify_rows يكشفها)
+    idx = row_indexes().get(title)
+    if idx is not None:
+        row_indexes()[title] = {**idx, "ids": idx["ids"] + tuple(str(i) for i in ids)}
+
+
+def verify_rows(ws, idx: dict, rows: dict) -> bool:
+    # rows = {id: رقم السطر} ⇒ True كان كل سطر مازال فيه نفس الـid
+    if len(rows) > VERIFY_MAX_CELLS:
+        fresh = row_index(ws, refresh=True)["ids"]
+        return all(len(fresh) >= r - 1 and fresh[r - 2] == rid for rid, r in rows.items())
+    ranges = [gspread.utils.rowcol_to_a1(r, idx["id_col"]) for r in rows.values()]
+    got = ws.batch_get(ranges)
+    return all((v[0][0] if v and v[0] else "") == rid for rid, v in zip(rows, got))
+
+
+def locate_rows(ws, ids) -> tuple[dict, dict]:
+    """
+    يرجّع (idx, {id: رقم السطر}) متأكّد منّو قبل الكتابة — ids اللي ما لقيناهمش ما يرجعوش
+    """
+    ids = list(dict.fromkeys(ids))
+    fresh = row_indexes().get(ws.title) is None
+    for _ in range(WRITE_RETRIES):
+        idx = row_index(ws)
+        pos = {rid: i for i, rid in enumerate(idx["ids"], start=2)}
+        rows = {rid: pos[rid] for rid in ids if rid in pos}
+        if len(rows) < len(ids) and not fresh:
+            # الـindex قديم (سطور تزادت من جلسة أخرى) ⇒ نعاودو نقراو عمود الـid
+            row_index(ws, refresh=True)
+            fresh = True
+            continue
+        if not rows or verify_rows(ws, idx, rows):
+            return idx, rows
+        if len(rows) <= VERIFY_MAX_CELLS:  # الطريق الآخر قرا العمود من جديد
+            row_index(ws, refresh=True)
+        fresh = True
+    raise WriteConflictError(f"{ws.title}: السطور تبدّلت أثناء الكتابة، عاود جرّب.")
+
+
+def append_record(sheet_name: str, cols: list[str], rec: dict, branch: str):
+    ensure_writable()
+    ws = ensure_branch_ws(sheet_name, cols, branch)
+    row = [str(rec.get(c, "")) for c in cols]
+    ws.append_row(row)
+    note_appended(ws.title, [rec.get("id", "")])
+    mark_changed(ws.title)
 
-def update_record_fields_by_id(sheet_name: str, cols: list[str], rec_id: str, updates: dict):
-    ws = ensure_ws(sheet_name, cols)
-    vals = ws.get_all_values()
-    if not vals or len(vals) < 2:
-        return
-    header = vals[0]
-    if "id" not in header:
-        return
-    id_idx = header.index("id")
 
-    row_idx = None
-    for i, r in enumerate(vals[1:], start=2):
-        if len(r) > id_idx and r[id_idx] == rec_id:
-            row_idx = i
-            break
-    if not row_idx:
+def delete_record_by_id(sheet_name: str, cols: list[str], rec_id: str, branch: str):
+    ensure_writable()
+    ws = ensure_branch_ws(sheet_name, cols, branch)
+    idx, rows = locate_rows(ws, [rec_id])
+    if rec_id not in rows:
         return
+    i = rows[rec_id]
+    ws.delete_rows(i)
+    row_indexes()[ws.title] = {**idx, "ids": idx["ids"][: i - 2] + idx["ids"][i - 1:]}
+    mark_changed(ws.title)
 
-    for field, value in updates.items():
-        if field in header:
-            col_idx = header.index(field) + 1
-            ws.update_cell(row_idx, col_idx, str(value))
-    st.cache_data.clear()
 
+def update_record_fields_by_id(sheet_name: str, cols: list[str], rec_id: str, updates: dict, branch: str):
+    update_records_by_ids(sheet_name, cols, {rec_id: updates}, branch)
 
-def delete_records_by_branch(sheet_name: str, cols: list[str], branch_value: str):
+
+def update_records_by_ids(sheet_name: str, cols: list[str], updates_by_id: dict, branch: str) -> int:
     """
-    حذف كل السجلات اللي عندها colonne 'branche' == branch_value
-    (يبقي الهيدر)
+    تعديل برشا سجلات في batch_update وحدة: updates_by_id = {id: {field: value}}
     """
-    ws = ensure_ws(sheet_name, cols)
-    vals = ws.get_all_values()
-    if not vals or len(vals) < 2:
+    ensure_writable()
+    if not updates_by_id:
         return 0
+    ws = ensure_branch_ws(sheet_name, cols, branch)
+    idx, rows = locate_rows(ws, updates_by_id)
+    header = idx["header"]
+
+    # الخانات المتلاصقة في نفس السطر ⇒ range واحد، و السطور المتتالية بنفس الأعمدة ⇒ block واحد
+    segs = []  # (سطر، أول عمود، [قيم])
+    for rid, i in sorted(rows.items(), key=lambda kv: kv[1]):
+        fields = sorted((header.index(f) + 1, str(v)) for f, v in updates_by_id[rid].items() if f in header)
+        for c, v in fields:
+            if segs and segs[-1][0] == i and segs[-1][1] + len(segs[-1][2]) == c:
+                segs[-1][2].append(v)
+            else:
+                segs.append((i, c, [v]))
+    blocks = []  # (أول سطر، أول عمود، [[قيم السطر]...])
+    for i, c, vals in segs:
+        last = blocks[-1] if blocks else None
+        if last and last[1] == c and len(last[2][0]) == len(vals) and last[0] + len(last[2]) == i:
+            last[2].append(vals)
+        else:
+            blocks.append((i, c, [vals]))
+    if blocks:
+        ws.batch_update([
+            {
+                "range": f"{gspread.utils.rowcol_to_a1(i, c)}:"
+                         f"{gspread.utils.rowcol_to_a1(i + len(vals) - 1, c + len(vals[0]) - 1)}",
+                "values": vals,
+            }
+            for i, c, vals in blocks
+        ])
+        mark_changed(ws.title)
+    return len(rows)
 
-    header = vals[0]
-    if "branche" not in header:
-        return 0
-    b_idx = header.index("branche")
 
-    # نجمع أرقام الصفوف اللي باش تتحذف (من تحت لفوق)
-    rows_to_delete = []
-    for i, r in enumerate(vals[1:], start=2):
-        if len(r) > b_idx and r[b_idx] == branch_value:
-            rows_to_delete.append(i)
+def set_field_by_ids(sheet_name: str, cols: list[str], ids, field: str, value, branch: str) -> int:
+    """
+    نفس القيمة في عمود واحد لبرشا سجلات (مثلا actif = 0 لمجموعة كمّلت) في update وحدة:
+    السطور المتتالية تتكتب كـrange واحد، و ما نمسّوش السطور اللي موش معنية
+    """
+    ensure_writable()
+    ws = ensure_branch_ws(sheet_name, cols, branch)
+    idx, rows = locate_rows(ws, ids)
+    if not rows or field not in idx["header"]:
+        return 0
+    col = idx["header"].index(field) + 1
+
+    hits = sorted(rows.values())
+    runs, start = [], hits[0]
+    for prev, cur in zip(hits, hits[1:] + [None]):
+        if cur != prev + 1:
+            runs.append((start, prev))
+            start = cur
+    ws.batch_update([
+        {
+            "range": f"{gspread.utils.rowcol_to_a1(a, col)}:{gspread.utils.rowcol_to_a1(b, col)}",
+            "values": [[str(value)]] * (b - a + 1),
+        }
+        for a, b in runs
+    ])
+    mark_changed(ws.title)
+    return len(hits)
 
-    for row_i in reversed(rows_to_delete):
-        ws.delete_rows(row_i)
 
-    if rows_to_delete:
-        st.cache_data.clear()
-    return len(rows_to_delete)
+def delete_records_by_branch(sheet_name: str, cols: list[str], branch_value: str):
+    """
+    حذف كل السجلات متاع الفرع (شيت الفرع كامل، يبقي الهيدر)
+    """
+    ensure_writable()
+    ws = ensure_branch_ws(sheet_name, cols, branch_value)
+    n = len(ws.col_values(1)) - 1
+    if n <= 0:
+        return 0
+    ws.delete_rows(2, n + 1)
+    forget_rows(ws.title)
+    mark_changed(ws.title)
+    return n
 
 
 def append_notification_log(
@@ -236,222 +658,623 @@ def append_notification_log(
         "period_label": period_label,
         "sent_at_iso": datetime.utcnow().isoformat(),
     }
-    append_record(NOTIF_LOG_SHEET, NOTIF_LOG_COLS, rec)
+    append_record(NOTIF_LOG_SHEET, NOTIF_LOG_COLS, rec, branche)
 
 
-# ================== Helpers ==================
-def normalize_phone(s: str) -> str:
-    digits = "".join(c for c in str(s) if c.isdigit())
-    if len(digits) == 8:
-        return "216" + digits
-    return digits
+# ============= Snapshot محلي (cold start سريع + وضع القراءة فقط) =============
+# كل loader يحفظ نسخة محلية من الشيت (pickle) بعد كل تحميل ناجح.
+# - بعد restart: نرجعو الـsnapshot طول (ms) ونحدّثو من Google في الخلفية.
+# - لو Google ما يجاوبش (كوتا/شبكة): نخدمو بالـsnapshot في وضع القراءة فقط.
+SNAPSHOT_DIR = os.path.join(".attendancehub_cache", "snapshots")
+SNAPSHOT_VERSION = 1  # بدّلها كي يتبدّل شكل الـsnapshot ⇒ القدام يتجاهلو
+OFFLINE_RETRY_SECONDS = 60  # في الوضع offline ما نعاودوش نجرّبو Google قبل المدة هذي
 
+BACKEND_ERRORS = (gse.APIError, requests.exceptions.RequestException, google.auth.exceptions.GoogleAuthError)
 
-def wa_link(number: str, message: str) -> str:
-    num = normalize_phone(number)
-    if not num:
-        return ""
-    return f"https://wa.me/{num}?text={urllib.parse.quote(message)}"
 
+class ReadOnlyError(RuntimeError):
+    pass
 
-def branch_password(branch: str) -> str:
+
+@st.cache_resource
+def snapshot_state() -> dict:
+    # حالة مشتركة بين كل الجلسات (تعيش طول حياة السيرفر)
+    return {
+        "lock": threading.Lock(),
+        "warm": set(),        # الشيتات اللي تحمّلو مرة من Google (أو بدا تحديثهم)
+        "fresh": {},          # title -> (النسخة المحلية، df) من التحديث في الخلفية
+        "offline_since": None,
+        "offline_error": "",
+    }
+
+
+def snapshot_path(title: str) -> str:
+    return os.path.join(SNAPSHOT_DIR, f"v{SNAPSHOT_VERSION}", f"{title}.pkl")
+
+
+def read_snapshot(title: str):
+    path = snapshot_path(title)
+    if not os.path.exists(path):
+        return None
     try:
-        m = st.secrets["branch_passwords"]
-        if "Menzel" in branch or branch == "MB":
-            return str(m.get("MB", ""))
-        if "Bizerte" in branch or branch == "BZ":
-            return str(m.get("BZ", ""))
+        return pd.read_pickle(path)
     except Exception:
+        return None
+
+
+def write_snapshot(title: str, df: pd.DataFrame):
+    path = snapshot_path(title)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{uuid.uuid4().hex[:6]}.tmp"
+        df.to_pickle(tmp)
+        os.replace(tmp, path)
+    except OSError:
         pass
-    return ""
 
 
-def as_float(x) -> float:
+def snapshot_saved_at(title: str):
+    path = snapshot_path(title)
+    if not os.path.exists(path):
+        return None
+    return datetime.fromtimestamp(os.path.getmtime(path))
+
+
+def set_offline(err: Exception):
+    state = snapshot_state()
+    with state["lock"]:
+        if state["offline_since"] is None:
+            state["offline_since"] = time.time()
+        state["offline_error"] = str(err)
+
+
+def set_online():
+    state = snapshot_state()
+    with state["lock"]:
+        state["offline_since"] = None
+        state["offline_error"] = ""
+
+
+def is_read_only() -> bool:
+    return snapshot_state()["offline_since"] is not None
+
+
+def ensure_writable():
+    if is_read_only():
+        raise ReadOnlyError("📴 Google Sheets غير متوفّر توّا: التطبيق في وضع القراءة فقط.")
+
+
+def refresh_snapshot_in_background(title: str, cols: list[str]):
+    # النتيجة تبدّل النسخة المحلية متاع الشيت ⇒ كل الكاشات المربوطة بالنسخة (10٪، rollups،
+    # export...) يتعاودو يتحسبو. كتابة صارت وقت التحديث ⇒ النتيجة قديمة و نسيّبوها
+    state = snapshot_state()
+    with state["lock"]:
+        before = data_versions().get(title, 0)
+
+    def run():
+        try:
+            # thread بلا session_state ⇒ نحلّو الـspreadsheet مباشرة بالـclient
+            ws = client.open_by_key(SPREADSHEET_ID).worksheet(title)
+            df = values_to_df(ws.get_all_values(), cols)
+        except BACKEND_ERRORS as e:
+            set_offline(e)
+            return
+        except gspread.WorksheetNotFound:
+            return
+        set_online()
+        with state["lock"]:
+            versions = data_versions()
+            if versions.get(title, 0) != before:
+                return
+            write_snapshot(title, df)
+            versions[title] = before + 1
+            state["fresh"][title] = (before + 1, df)
+
+    threading.Thread(target=run, name=f"snapshot-refresh-{title}", daemon=True).start()
+
+
+def open_worksheet_once(title: str):
+    # عندنا snapshot نرجعولو ⇒ محاولة وحدة (بلا retries متاع get_spreadsheet و st.error)
+    sh = st.session_state.get("sh_obj") or client.open_by_key(SPREADSHEET_ID)
+    return sh.worksheet(title)
+
+
+def load_sheet_df(title: str, cols: list[str], open_ws):
+    """
+    تحميل شيت مع snapshot محلي:
+    fresh من الخلفية ⇒ snapshot في cold start ⇒ Google ⇒ snapshot لو Google طايح
+    """
+    with timed(f"load:{title}"):
+        return _load_sheet_df(title, cols, open_ws)
+
+
+def _load_sheet_df(title: str, cols: list[str], open_ws):
+    state = snapshot_state()
+    with state["lock"]:
+        fresh = state["fresh"].pop(title, None)
+        first_load = title not in state["warm"]
+        state["warm"].add(title)
+        offline_for = time.time() - state["offline_since"] if state["offline_since"] else None
+        # fresh يصلح كان لنفس النسخة اللي حطّها التحديث (كتابة بعدو ⇒ نقراو من Google)
+        if fresh is not None and fresh[0] == data_versions().get(title, 0):
+            return fresh[1]
+
+    snap = read_snapshot(title)
+    if snap is not None and first_load:
+        refresh_snapshot_in_background(title, cols)
+        return snap
+    if snap is not None and offline_for is not None and offline_for < OFFLINE_RETRY_SECONDS:
+        return snap
+
     try:
-        return float(str(x).replace(",", ".").strip() or 0)
-    except Exception:
-        return 0.0
+        if snap is not None:
+            try:
+                ws = open_worksheet_once(title)
+            except gspread.WorksheetNotFound:
+                ws = open_ws()
+        else:
+            ws = open_ws()
+        df = values_to_df(ws.get_all_values(), cols)
+    except BACKEND_ERRORS as e:
+        if snap is None:
+            raise
+        set_offline(e)
+        return snap
+    set_online()
+    write_snapshot(title, df)
+    return df
 
 
-def build_whatsapp_message_for_trainee(
-    tr_row,
-    df_abs_all,
-    df_sub_all,
-    branch_name,
-    d_from: date,
-    d_to: date,
-    period_label: str,
-) -> tuple[str, list[str]]:
-    trainee_id = tr_row["id"]
-    df_abs_t = df_abs_all[df_abs_all["trainee_id"] == trainee_id].copy()
-
-    if df_abs_t.empty:
-        return "", ["لا توجد غيابات لهذا المتكوّن في أي فترة."]
-
-    df_abs_t["date_dt"] = pd.to_datetime(df_abs_t["date"], errors="coerce")
-    mask_period = (df_abs_t["date_dt"].dt.date >= d_from) & (df_abs_t["date_dt"].dt.date <= d_to)
-    df_abs_period = df_abs_t[mask_period].copy()
-
-    if df_abs_period.empty:
-        return "", ["لا توجد غيابات في هذه الفترة."]
-
-    df_abs_period = df_abs_period.merge(
-        df_sub_all[["id", "nom_matiere", "heures_totales"]],
-        left_on="subject_id",
-        right_on="id",
-        how="left",
-        suffixes=("", "_sub"),
+# ============= تحميل البيانات من Google Sheets =============
+# كل loader يجيب كان شيت الفرع متاعو، والكاش مفصول حسب (الفرع، النسخة):
+# نسخة ما تبدّلتش (حتى في _Meta) ⇒ ما نعاودوش نقراو الشيت
+@st.cache_data(ttl=LOADER_MAX_AGE, max_entries=32)
+def fetch_trainees(branch: str, version: tuple):
+    return load_sheet_df(
+        branch_sheet(TRAINEES_SHEET, branch),
+        TRAINEES_COLS,
+        lambda: ensure_branch_ws(TRAINEES_SHEET, TRAINEES_COLS, branch),
     )
 
-    detail_lines = []
-    for _, r in df_abs_period.iterrows():
-        dstr = r["date_dt"].strftime("%Y-%m-%d") if pd.notna(r["date_dt"]) else str(r["date"])
-        subj = str(r.get("nom_matiere", "") or "").strip()
-        h = as_float(r.get("heures_absence", 0))
-        just = "مبرر" if str(r.get("justifie", "")).strip() == "Oui" else "غير مبرر"
-        detail_lines.append(f"- {dstr} | {subj} | {h:.2f} ساعة ({just})")
-
-    df_eff_t = df_abs_period[df_abs_period["justifie"] != "Oui"].copy()
-    df_eff_t["heures_absence_f"] = df_eff_t["heures_absence"].apply(as_float)
-    df_eff_t["heures_totales_f"] = df_eff_t["heures_totales"].apply(as_float)
-
-    stats_lines = []
-    elim_lines = []
-
-    if not df_eff_t.empty:
-        grp_t = df_eff_t.groupby("nom_matiere", as_index=False).agg(
-            total_abs=("heures_absence_f", "sum"),
-            heures_tot=("heures_totales_f", "first"),
-        )
-        grp_t["limit_10"] = grp_t["heures_tot"] * 0.10
-        grp_t["remaining"] = grp_t["limit_10"] - grp_t["total_abs"]
-
-        for _, g in grp_t.iterrows():
-            mat_name = str(g["nom_matiere"]).strip()
-            total_abs = g["total_abs"]
-            remaining = g["remaining"]
-
-            stats_lines.append(
-                f"- {mat_name}:\n"
-                f"   • مجموع الغياب غير المبرر: {total_abs:.2f} ساعة\n"
-                f"   • الباقي قبل الإقصاء (10٪): {remaining:.2f} ساعة من مجموع الساعات الجملية"
+
+@st.cache_data(ttl=LOADER_MAX_AGE, max_entries=32)
+def fetch_subjects(branch: str, version: tuple):
+    return load_sheet_df(
+        branch_sheet(SUBJECTS_SHEET, branch),
+        SUBJECTS_COLS,
+        lambda: ensure_branch_ws(SUBJECTS_SHEET, SUBJECTS_COLS, branch),
+    )
+
+
+@st.cache_resource(ttl=LOADER_MAX_AGE, max_entries=8)
+def fetch_absences(branch: str, version: tuple) -> pd.DataFrame:
+    # الشكل الوحيد في الذاكرة: نسخة مضغوطة (compact_absences) مشتركة بين الجلسات — read-only
+    # (cache_data كان يرجّع نسخة نص جديدة في كل call و يخلّيها في الكاش حذا الـcompact)
+    return compact_absences(load_sheet_df(
+        branch_sheet(ABSENCES_SHEET, branch),
+        ABSENCES_COLS,
+        lambda: ensure_branch_ws(ABSENCES_SHEET, ABSENCES_COLS, branch),
+    ))
+
+
+@st.cache_data(ttl=LOADER_MAX_AGE, max_entries=32)
+def fetch_notifications(branch: str, version: tuple):
+    return load_sheet_df(
+        branch_sheet(NOTIF_LOG_SHEET, branch),
+        NOTIF_LOG_COLS,
+        lambda: ensure_branch_ws(NOTIF_LOG_SHEET, NOTIF_LOG_COLS, branch),
+    )
+
+
+def load_trainees(branch: str):
+    return fetch_trainees(branch, data_version(branch_sheet(TRAINEES_SHEET, branch)))
+
+
+def load_subjects(branch: str):
+    return fetch_subjects(branch, data_version(branch_sheet(SUBJECTS_SHEET, branch)))
+
+
+def load_notifications(branch: str):
+    return fetch_notifications(branch, data_version(branch_sheet(NOTIF_LOG_SHEET, branch)))
+
+
+def absences_frame(branch: str) -> pd.DataFrame:
+    return fetch_absences(branch, data_version(branch_sheet(ABSENCES_SHEET, branch)))
+
+
+@st.cache_resource
+def unjustified_cache() -> dict:
+    # فرع -> {"key": ..., "grp": unjustified_totals متاع السنة الحالية} مشترك بين الجلسات
+    return {}
+
+
+def unjustified_key(branch: str) -> tuple:
+    # النسخة فيها refresh_epoch ⇒ التبديلات اليدوية تبان؛ السنة ⇒ 1 سبتمبر يبدّل الحساب
+    return branch_data_version(branch), current_academic_year()
+
+
+def branch_unjustified(branch: str) -> pd.DataFrame:
+    key = unjustified_key(branch)
+    entry = unjustified_cache().get(branch)
+    if entry is None or entry["key"] != key:
+        with timed("totals:full"):
+            grp = unjustified_totals(
+                load_trainees(branch),
+                load_subjects(branch),
+                in_current_year(absences_frame(branch), "date"),
             )
+        entry = {"key": key, "grp": grp}
+        unjustified_cache()[branch] = entry
+    return entry["grp"]
 
-            if remaining <= 0:
-                elim_lines.append(f"- {mat_name}")
-
-    msg_lines = []
-    msg_lines.append("السلام عليكم،")
-    msg_lines.append("إدارة هيكل التكوين تحب تعلمك بتفاصيل الغيابات اللي تمّ تسجيلها في الفترة المحدّدة:")
-    msg_lines.append("")
-    msg_lines.append(f"👤 المتكوّن: {tr_row.get('nom', '')}")
-    msg_lines.append(f"🏫 الفرع: {branch_name}")
-    msg_lines.append(f"🔧 التخصّص: {tr_row.get('specialite', '')}")
-    msg_lines.append(f"🕒 الفترة: {period_label}")
-    msg_lines.append("")
-    msg_lines.append("📋 تفاصيل الغيابات في هذه الفترة:")
-    msg_lines.extend(detail_lines)
-
-    if stats_lines:
-        msg_lines.append("")
-        msg_lines.append("📊 ملخّص الغيابات غير المبررة حسب المواد:")
-        msg_lines.extend(stats_lines)
-
-    if elim_lines:
-        msg_lines.append("")
-        msg_lines.append("⚠️ تنبيه: في بعض المواد تمّ تجاوز الحد الأقصى للغيابات ويمكن يترتّب عليه الإقصاء:")
-        msg_lines.extend(elim_lines)
-
-    msg_lines.append("")
-    msg_lines.append("🙏 نشكروك على تفهّمك، ومرحبا بيك في الإدارة لأي استفسار.")
-
-    msg = "\n".join(msg_lines)
-
-    info_debug = [
-        f"غيابات في الفترة: {len(df_abs_period)}",
-        f"غيابات غير مبررة محسوبة لــ10٪: {len(df_eff_t)}",
-    ]
-    return msg, info_debug
 
+@st.cache_data(ttl=300, max_entries=16)
+def branch_projection(branch: str, version: tuple) -> pd.DataFrame:
+    # version = نسخ الشيتات (متكوّنين، مواد، غيابات) ⇒ يتعاود يتحسب كان كي تتبدّل الداتا
+    return breach_projection(branch_unjustified(branch))
 
-# ============= تحميل البيانات من Google Sheets =============
-@st.cache_data(ttl=300)
-def load_trainees():
-    ws = ensure_ws(TRAINEES_SHEET, TRAINEES_COLS)
-    vals = ws.get_all_values()
-    if not vals or len(vals) < 2:
-        return pd.DataFrame(columns=TRAINEES_COLS)
-    return pd.DataFrame(vals[1:], columns=vals[0])
 
+def justify_absences(branch: str, rows: pd.DataFrame, comment: str) -> int:
+    """
+    تبرير برشا غيابات (شهادة طبية) في batch_update وحدة؛ مجاميع 10٪ تتحدّث بالفرق
+    (ساعات السطور هذي) عوض إعادة الحساب على الفرع الكل
+    """
+    comment = comment.strip()
+    updates = {}
+    for rid, old in zip(rows["id"].astype(str), rows["commentaire"].astype(str)):
+        old = "" if old == "nan" else old.strip()
+        updates[rid] = {
+            "justifie": "Oui",
+            "commentaire": f"{old} | {comment}" if old and comment and comment not in old else (old or comment),
+        }
+    before = unjustified_key(branch)
+    n = update_records_by_ids(ABSENCES_SHEET, ABSENCES_COLS, updates, branch)
+    entry = unjustified_cache().get(branch)
+    if n == len(updates) and entry is not None and entry["key"] == before:
+        with timed("totals:delta"):
+            grp = apply_justification_delta(entry["grp"], in_current_year(rows, "date"))
+        unjustified_cache()[branch] = {"key": unjustified_key(branch), "grp": grp}
+    return n
 
-@st.cache_data(ttl=300)
-def load_subjects():
-    ws = ensure_ws(SUBJECTS_SHEET, SUBJECTS_COLS)
-    vals = ws.get_all_values()
-    if not vals or len(vals) < 2:
-        return pd.DataFrame(columns=SUBJECTS_COLS)
-    return pd.DataFrame(vals[1:], columns=vals[0])
 
+@st.cache_data(ttl=300, max_entries=16)
+def branch_notifications_index(branch: str, version: tuple) -> pd.DataFrame:
+    return notifications_index(load_notifications(branch))
 
-@st.cache_data(ttl=300)
-def load_absences():
-    ws = ensure_ws(ABSENCES_SHEET, ABSENCES_COLS)
+
+def branch_data_version(branch: str) -> tuple:
+    return tuple(data_version(branch_sheet(b, branch)) for b in (TRAINEES_SHEET, SUBJECTS_SHEET, ABSENCES_SHEET))
+
+
+# ============= كاش تقارير الفترة =============
+@st.cache_resource
+def report_cache() -> ReportCache:
+    return ReportCache(max_entries=512)
+
+
+@st.cache_data(ttl=300, max_entries=16)
+def branch_trainee_fingerprints(branch: str, version: tuple) -> dict:
+    return trainee_fingerprints(absences_frame(branch))
+
+
+def trainee_period_report(branch: str, tr_row: dict, d_from: date, d_to: date, label: str, target: str, phone: str):
+    """
+    (رسالة، info، رابط wa.me) من الكاش كان غيابات المتكوّن و المواد ما تبدّلوش، وإلا يتعاود يتبنى
+    """
+    tid = str(tr_row["id"])
+    fingerprints = branch_trainee_fingerprints(branch, data_version(branch_sheet(ABSENCES_SHEET, branch)))
+    fingerprint = (
+        fingerprints.get(tid, 0),
+        data_version(branch_sheet(SUBJECTS_SHEET, branch)),
+        tuple(str(tr_row.get(c, "")) for c in TRAINEES_COLS),
+        phone,
+    )
+
+    def build():
+        with timed("report:build"):
+            msg, info = build_whatsapp_message_for_trainee(
+                tr_row, absences_frame(branch), load_subjects(branch), branch, d_from, d_to, label
+            )
+            return msg, info, wa_link(phone, msg) if msg else ""
+
+    return report_cache().get_or_build((tid, d_from, d_to, label, target), fingerprint, build)
+
+
+# ============= إحصائيات (rollups) =============
+@st.cache_resource
+def rollup_cubes() -> dict:
+    # فرع -> RollupCube مشترك بين كل الجلسات
+    return {}
+
+
+def branch_rollups(branch: str) -> RollupCube:
+    cube = rollup_cubes().setdefault(branch, RollupCube())
+    # نعاودو نقارنو السطور كان كي تتبدّل النسخة (محلية، _Meta ولا refresh_epoch)
+    key = branch_data_version(branch)
+    if cube.key != key:
+        with timed("rollup:update"):
+            cube.update(absences_frame(branch), load_trainees(branch), load_subjects(branch), key=key)
+    return cube
+
+
+# ============= أرشيف السنوات الدراسية =============
+# الشيتات "الساخنة" (Absences_XX, Notifications_Log_XX) تبقى فيها كان السنة الحالية.
+# السنوات المغلقة تتنقل لشيتات أرشيف: Absences_MB_2024-2025 ...
+
+# عمود التاريخ اللي نحدّدو بيه السنة في كل شيت يتأرشف
+ARCHIVE_DATE_COLS = {
+    ABSENCES_SHEET: "date",
+    NOTIF_LOG_SHEET: "sent_at_iso",
+}
+
+
+def archive_sheet(base: str, branch: str, year_label: str) -> str:
+    return f"{branch_sheet(base, branch)}_{year_label}"
+
+
+def archive_closed_years(sheet_name: str, cols: list[str], branch: str) -> dict[str, int]:
+    """
+    ننقلو السطور متاع السنوات المغلقة لشيتات الأرشيف، و نحذفوهم برك من الشيت الساخن
+    (السطور متاع السنة الحالية ما يتمسّوش). يرجّع {السنة: عدد السطور المؤرشفة}
+    """
+    ensure_writable()
+    date_col = ARCHIVE_DATE_COLS[sheet_name]
+    ws = ensure_branch_ws(sheet_name, cols, branch)
     vals = ws.get_all_values()
     if not vals or len(vals) < 2:
-        return pd.DataFrame(columns=ABSENCES_COLS)
-    return pd.DataFrame(vals[1:], columns=vals[0])
+        return {}
+    header = vals[0]
+    d_idx = header.index(date_col)
+    cur_year = current_academic_year()
+
+    dts = pd.to_datetime(pd.Series([r[d_idx] if len(r) > d_idx else "" for r in vals[1:]]), errors="coerce")
+    start_y = dts.dt.year - (dts.dt.month < ACADEMIC_YEAR_START_MONTH).astype(int)
+    years = [f"{int(y)}-{int(y) + 1}" if pd.notna(y) else cur_year for y in start_y]
+
+    # سطر بلا id ما نجموش نتأكّدو من بلاصتو (locate_rows) ⇒ يقعد في الشيت الساخن
+    id_idx = header.index("id")
+    closed = {}
+    for r, year in zip(vals[1:], years):
+        rid = r[id_idx] if len(r) > id_idx else ""
+        if year < cur_year and rid:
+            closed[rid] = (year, r)
+    if not closed:
+        return {}
+    # السطور اللي حذفتها/بدّلت بلاصتها جلسة أخرى من بعد ما قرينا ما يتنقلوش
+    _, rows = locate_rows(ws, closed)
+    if not rows:
+        return {}
+
+    # 1) نكتبو في الأرشيف قبل، 2) من بعد نحذفو السطور المؤرشفة برك (من اللوطة للفوق ⇒ أرقام
+    # السطور اللي قبل ما تتبدّلش). كان الحذف طاح في النص: سطور مكرّرة في الأرشيف، ما يضيع شي
+    by_year = {}
+    for rid in sorted(rows, key=rows.get):
+        year, r = closed[rid]
+        by_year.setdefault(year, []).append(r)
+    for year, arch_rows in sorted(by_year.items()):
+        ws_arch = ensure_ws(archive_sheet(sheet_name, branch, year), header)
+        ws_arch.append_rows(arch_rows)
+
+    hits = sorted(rows.values())
+    runs, start = [], hits[0]
+    for prev, cur in zip(hits, hits[1:] + [None]):
+        if cur != prev + 1:
+            runs.append((start, prev))
+            start = cur
+    try:
+        for a, b in reversed(runs):
+            ws.delete_rows(a, b)
+    finally:
+        forget_rows(ws.title)
+        mark_changed(ws.title)
+    list_archive_years.clear()
+    fetch_archive.clear()
+    return {y: len(arch_rows) for y, arch_rows in sorted(by_year.items())}
 
 
 @st.cache_data(ttl=300)
-def load_notifications():
-    ws = ensure_ws(NOTIF_LOG_SHEET, NOTIF_LOG_COLS)
-    vals = ws.get_all_values()
-    if not vals or len(vals) < 2:
-        return pd.DataFrame(columns=NOTIF_LOG_COLS)
-    return pd.DataFrame(vals[1:], columns=vals[0])
+def list_archive_years(sheet_name: str, branch: str) -> list[str]:
+    prefix = branch_sheet(sheet_name, branch) + "_"
+    titles = None
+    if not is_read_only():
+        try:
+            titles = [ws.title for ws in get_spreadsheet().worksheets()]
+        except BACKEND_ERRORS as e:
+            set_offline(e)
+    if titles is None:
+        # offline ⇒ نعرضو كان الأرشيف اللي عندو snapshot محلي
+        snap_dir = os.path.dirname(snapshot_path(prefix))
+        files = os.listdir(snap_dir) if os.path.isdir(snap_dir) else []
+        titles = [f[: -len(".pkl")] for f in files if f.endswith(".pkl")]
+    return sorted((t[len(prefix):] for t in titles if t.startswith(prefix)), reverse=True)
 
 
-# ================== Sidebar: اختيار الفرع + المودباس ==================
-st.sidebar.markdown("## ⚙️ إعدادات الفرع")
+@st.cache_data(ttl=3600, max_entries=8)
+def fetch_archive(sheet_name: str, cols: list[str], branch: str, year_label: str, version: tuple):
+    # الأرشيف ما يتبدّلش ⇒ كاش أطول، ويتقرا كان وقت يطلبو
+    title = archive_sheet(sheet_name, branch, year_label)
+    return load_sheet_df(title, cols, lambda: ensure_ws(title, cols))
 
-branch = st.sidebar.selectbox("اختر الفرع", ["Menzel Bourguiba", "Bizerte"])
 
-pw_need = branch_password(branch)
-key_pw = f"branch_pw_ok::{branch}"
+def load_archive(sheet_name: str, cols: list[str], branch: str, year_label: str):
+    version = data_version(archive_sheet(sheet_name, branch, year_label))
+    return fetch_archive(sheet_name, cols, branch, year_label, version)
 
-if pw_need:
-    if key_pw not in st.session_state:
-        st.session_state[key_pw] = False
-    if not st.session_state[key_pw]:
-        pw_try = st.sidebar.text_input("🔐 كلمة سرّ الفرع", type="password")
-        if st.sidebar.button("دخول الفرع"):
-            if pw_try == pw_need:
-                st.session_state[key_pw] = True
-                st.sidebar.success("تم الدخول ✅")
-            else:
-                st.sidebar.error("كلمة سرّ غير صحيحة ❌")
-        st.stop()
-else:
-    st.sidebar.warning("⚠️ لم يتم ضبط كلمة المرور لهذا الفرع في secrets.branch_passwords")
 
+# ============= Export كامل للفرع =============
+# الملف يتبنى مرة وحدة لكل نسخة داتا (متكوّنين، مواد، غيابات + سنوات الأرشيف) و يتحفظ في الديسك
+# ⇒ التحميلات اللي بعدو (حتى من جلسات أخرى) ما تعاودش تحسب.
+EXPORT_DIR = os.path.join(".attendancehub_cache", "exports")
+
+
+def export_path(branch: str, fmt: str) -> str:
+    years = tuple(list_archive_years(ABSENCES_SHEET, branch))
+    key = hashlib.sha1(repr((branch_data_version(branch), years)).encode()).hexdigest()[:12]
+    return os.path.join(EXPORT_DIR, f"{branch_code(branch)}_{key}.{fmt}")
+
+
+def export_sources(branch: str):
+    # السنة الحالية ثم الأرشيف سنة بسنة (كل frame يتحمّل وقت يلزم و ما يتخبّاش في الكاش
+    # ⇒ export فيه برشا سنين ما يعبّيش الذاكرة)
+    yield absences_frame(branch)
+    for year in list_archive_years(ABSENCES_SHEET, branch):
+        title = archive_sheet(ABSENCES_SHEET, branch, year)
+        yield load_sheet_df(title, ABSENCES_COLS, lambda: ensure_ws(title, ABSENCES_COLS))
+
+
+def build_export(branch: str, fmt: str) -> str:
+    path = export_path(branch, fmt)
+    if os.path.exists(path):
+        return path
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    tmp = f"{path}.{uuid.uuid4().hex[:6]}.tmp"
+    with timed(f"export:{fmt}"):
+        try:
+            write_export(export_chunks(export_sources(branch), load_trainees(branch), load_subjects(branch)), tmp, fmt)
+            os.replace(tmp, path)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+    # نفس الفرع و الصيغة بنسخة قديمة ⇒ ما عادش يلزم
+    prefix = f"{branch_code(branch)}_"
+    for f in os.listdir(EXPORT_DIR):
+        old = os.path.join(EXPORT_DIR, f)
+        if f.startswith(prefix) and f.endswith(f".{fmt}") and old != path:
+            try:
+                os.remove(old)
+            except OSError:
+                pass
+    return path
+
+
+# ============= كشف الغيابات المكرّرة =============
+DUP_MODES = {
+    "skip": "⏭️ تجاهل المكرّر",
+    "overwrite": "♻️ تعويض القديم",
+    "flag": "🚩 تسجيل مع علامة",
+}
+
+
+@st.cache_resource(ttl=300, max_entries=16)
+def branch_absence_keys(branch: str, version: tuple, with_hours: bool) -> dict[str, str]:
+    # {مفتاح: id} — يتعاود يتبنى كي تتبدّل نسخة شيت الغيابات؛ dict مشترك read-only
+    # (cache_data كان يعاود يعمل unpickle للـdict الكل في كل lookup)
+    df = absences_frame(branch)
+    if df.empty:
+        return {}
+    return dict(zip(absence_keys(df, with_hours), df["id"]))
+
+
+def absence_key_index(branch: str, with_hours: bool = False) -> dict[str, str]:
+    return branch_absence_keys(branch, data_version(branch_sheet(ABSENCES_SHEET, branch)), with_hours)
+
+
+# ============= Import غيابات (streaming + validation) =============
+# التحقق و القراءة بالـchunks في attendance_engine، هنا الكتابة في شيت الفرع
+
+
+def append_records(sheet_name: str, cols: list[str], recs: pd.DataFrame, branch: str):
+    # كتابة برشا سطور في call وحدة (append_rows)
+    ensure_writable()
+    if recs.empty:
+        return 0
+    ws = ensure_branch_ws(sheet_name, cols, branch)
+    rows = recs.reindex(columns=cols).fillna("").astype(str).values.tolist()
+    ws.append_rows(rows)
+    note_appended(ws.title, recs["id"] if "id" in recs else [""] * len(rows))
+    mark_changed(ws.title)
+    return len(rows)
+
+
+def import_absences_file(
+    uploaded,
+    branch: str,
+    trainee_ids: set,
+    subject_ids: set,
+    dup_index: dict,
+    dup_mode: str = "skip",
+    with_hours: bool = False,
+    on_progress=None,
+) -> dict:
+    total_ok, total_rej, total_upd, line = 0, 0, 0, 2  # السطر 1 هو الهيدر
+    rejects, seen = [], set()
+    for chunk, progress in iter_upload_chunks(uploaded):
+        missing = [c for c in IMPORT_REQUIRED_COLS if c not in chunk.columns]
+        if missing:
+            raise ValueError(f"الملف لازم يحتوي الأعمدة: {', '.join(missing)}")
+        ok, rej = validate_absence_chunk(chunk, trainee_ids, subject_ids, line)
+        line += len(chunk)
+        ok, updates, dups = apply_duplicate_policy(ok, dup_index, seen, dup_mode, with_hours)
+        if not dups.empty:
+            dups = dups.drop(columns=["id"]).assign(**{"سبب الرفض": "غياب مكرّر"})
+            rej = pd.concat([rej, dups], ignore_index=True)
+        total_ok += append_records(ABSENCES_SHEET, ABSENCES_COLS, ok, branch)
+        total_upd += update_records_by_ids(ABSENCES_SHEET, ABSENCES_COLS, updates, branch)
+        total_rej += len(rej)
+        kept = sum(len(r) for r in rejects)
+        if not rej.empty and kept < IMPORT_MAX_REJECT_ROWS:
+            rejects.append(rej.head(IMPORT_MAX_REJECT_ROWS - kept).astype(str))
+        if on_progress is not None:
+            on_progress(progress, total_ok, total_rej)
+    return {
+        "ok": total_ok,
+        "updated": total_upd,
+        "rejected": total_rej,
+        "rejects": pd.concat(rejects, ignore_index=True) if rejects else pd.DataFrame(),
+    }
+
+
+def import_roster_file(uploaded, branch: str, df_tr: pd.DataFrame, default_spec: str, default_date: date) -> dict:
+    # القائمة صغيرة (30–60 متكوّن) ⇒ نقراوها كاملة، و الكتابة append_rows وحدة
+    df = pd.concat([chunk for chunk, _ in iter_upload_chunks(uploaded)], ignore_index=True)
+    missing = [c for c in ROSTER_REQUIRED_COLS if c not in df.columns]
+    if missing:
+        raise ValueError(f"الملف لازم يحتوي الأعمدة: {', '.join(missing)}")
+    new, rejected = prepare_roster(df, df_tr, branch, default_spec, default_date)
+    n = append_records(TRAINEES_SHEET, TRAINEES_COLS, new, branch)
+    return {"ok": n, "rejects": rejected.astype(str)}
+
+
+# ================== Sidebar: حالة الفرع ==================
+flush_meta()  # كتابات الـrun اللي قبل (وفى بـst.rerun قبل آخر السكريبت)
 st.sidebar.success(f"أنت الآن داخل فرع: **{branch}**")
+if st.sidebar.button("🔄 تحديث الداتا", help="بعد تبديل يدوي في Google Sheets (التطبيق يشوفو وحدو بعد ساعة)"):
+    bump_refresh_epoch()
+    st.cache_data.clear()
+    row_indexes().clear()
+    unjustified_cache().clear()
+    st.rerun()
+
+if is_read_only():
+    saved_at = snapshot_saved_at(branch_sheet(ABSENCES_SHEET, branch))
+    st.sidebar.error(
+        "📴 Google Sheets غير متوفّر: وضع القراءة فقط (نسخة محلية"
+        + (f" بتاريخ {saved_at:%Y-%m-%d %H:%M}" if saved_at else "")
+        + ")."
+    )
+    if st.sidebar.button("🔄 إعادة الاتصال"):
+        set_online()
+        bump_refresh_epoch()  # حتى الغيابات (cache_resource) يتعاودو يتجابو من Google
+        st.cache_data.clear()
+        st.rerun()
 
-tab1, tab2, tab3, tab4, tab5 = st.tabs(
+tab1, tab2, tab3, tab4, tab5, tab6, tab7 = st.tabs(
     [
         "👤 المتكوّنون",
         "📚 المواد",
         "📅 الغيابات",
         "🚨 تجاوز 10٪ + واتساب",
         "📜 سجل الإشعارات",
+        "🗄️ الأرشيف",
+        "📈 إحصائيات",
     ]
 )
 
 # ----------------- تبويب 1: المتكوّنون -----------------
-with tab1:
+with tab1, timed("tab1"):
     st.subheader("👤 إدارة المتكوّنين")
 
-    df_tr = load_trainees()
-    df_tr = df_tr[df_tr["branche"] == branch].copy()
+    df_tr = load_trainees(branch)
 
     st.markdown("### ➕ إضافة متكوّن جديد")
     with st.form("add_trainee_form"):
@@ -482,12 +1305,54 @@ with tab1:
                 "actif": "1",
             }
             try:
-                append_record(TRAINEES_SHEET, TRAINEES_COLS, new_row)
+                append_record(TRAINEES_SHEET, TRAINEES_COLS, new_row, branch)
                 st.success("✅ تم إضافة المتكوّن.")
                 st.rerun()
             except Exception as e:
                 st.error(f"خطأ أثناء إضافة المتكوّن: {e}")
 
+    st.markdown("### 📥 استيراد قائمة متكوّنين (Excel/CSV)")
+    with st.expander("مجموعة جديدة كاملة في مرّة وحدة"):
+        st.info(
+            "الأعمدة: nom، telephone (إجباريين)؛ إختياري: tel_parent، specialite، date_debut (YYYY-MM-DD).\n"
+            "التخصّص و تاريخ البداية ينجمو يتعبّاو هنا للمجموعة كاملة."
+        )
+        roster_tmpl = pd.DataFrame(columns=["nom", "telephone", "tel_parent", "specialite", "date_debut"])
+        st.download_button(
+            "⬇️ تحميل نموذج CSV فارغ",
+            data=roster_tmpl.to_csv(index=False).encode("utf-8-sig"),
+            file_name="trainees_template.csv",
+            mime="text/csv",
+            key="roster_template",
+        )
+        colR1, colR2 = st.columns(2)
+        with colR1:
+            roster_spec = st.text_input("🔧 التخصّص (كي العمود فارغ)", key="roster_spec")
+        with colR2:
+            roster_date = st.date_input("📅 تاريخ البداية (كي العمود فارغ)", value=date.today(), key="roster_date")
+        roster_file = st.file_uploader("حمّل القائمة (CSV أو Excel)", type=["csv", "xlsx"], key="roster_file")
+        if roster_file is not None and st.button("📥 استيراد المجموعة", key="roster_import"):
+            try:
+                st.session_state[f"roster_report::{branch}"] = import_roster_file(
+                    roster_file, branch, df_tr, roster_spec, roster_date
+                )
+            except Exception as e:
+                st.error(f"❌ خطأ أثناء قراءة الملف: {e}")
+
+        res_r = st.session_state.get(f"roster_report::{branch}")
+        if res_r:
+            st.success(f"✅ تم إضافة {res_r['ok']} متكوّن(ين).")
+            if not res_r["rejects"].empty:
+                st.warning(f"⚠️ {len(res_r['rejects'])} سطر(ات) مرفوضة (مكرّر ولا ناقص).")
+                st.dataframe(res_r["rejects"], use_container_width=True)
+                st.download_button(
+                    "⬇️ تحميل تقرير الرفض (CSV)",
+                    data=res_r["rejects"].to_csv(index=False).encode("utf-8-sig"),
+                    file_name="trainees_import_rejects.csv",
+                    mime="text/csv",
+                    key="roster_rejects_dl",
+                )
+
     st.markdown("### 📋 قائمة المتكوّنين في هذا الفرع")
     if df_tr.empty:
         st.info("لا يوجد متكوّنون بعد في هذا الفرع.")
@@ -508,28 +1373,63 @@ with tab1:
                 try:
                     idx = int(pick_tr_del.split("]")[0].replace("[", "").strip())
                     tr_id = df_tr.iloc[idx]["id"]
-                    delete_record_by_id(TRAINEES_SHEET, TRAINEES_COLS, tr_id)
+                    delete_record_by_id(TRAINEES_SHEET, TRAINEES_COLS, tr_id, branch)
                     st.success("✅ تم الحذف.")
                     st.rerun()
                 except Exception as e:
                     st.error(f"خطأ أثناء الحذف: {e}")
 
+        st.markdown("### 🔁 تعديل جماعي (تفعيل / تعطيل)")
+        specs_tr = sorted([s for s in df_tr["specialite"].dropna().unique() if s])
+        colU1, colU2 = st.columns(2)
+        with colU1:
+            spec_upd = st.selectbox("🔧 التخصّص", ["(الكل)"] + specs_tr, key="bulk_tr_spec")
+        with colU2:
+            starts = sorted(df_tr["date_debut"].dropna().unique(), reverse=True)
+            start_upd = st.selectbox("📅 تاريخ البداية", ["(الكل)"] + starts, key="bulk_tr_start")
+        df_tr_upd = df_tr
+        if spec_upd != "(الكل)":
+            df_tr_upd = df_tr_upd[df_tr_upd["specialite"] == spec_upd]
+        if start_upd != "(الكل)":
+            df_tr_upd = df_tr_upd[df_tr_upd["date_debut"] == start_upd]
+
+        names_upd = dict(zip(df_tr_upd["id"], df_tr_upd["nom"]))
+        ids_upd = st.multiselect(
+            "المتكوّنين",
+            list(names_upd),
+            default=list(names_upd),
+            format_func=names_upd.get,
+            key=f"bulk_tr_ids::{spec_upd}::{start_upd}",
+        )
+        actif_new = st.radio(
+            "الحالة",
+            ["0", "1"],
+            format_func={"0": "⏸️ تعطيل (actif = 0)", "1": "▶️ تفعيل (actif = 1)"}.get,
+            horizontal=True,
+            key="bulk_tr_actif",
+        )
+        if st.button(f"💾 تطبيق على {len(ids_upd)} متكوّن", key="bulk_tr_apply", disabled=not ids_upd):
+            try:
+                n = set_field_by_ids(TRAINEES_SHEET, TRAINEES_COLS, ids_upd, "actif", actif_new, branch)
+                st.success(f"✅ تم تحديث {n} متكوّن(ين).")
+                st.rerun()
+            except Exception as e:
+                st.error(f"خطأ أثناء التعديل الجماعي: {e}")
+
 # ----------------- تبويب 2: المواد -----------------
-with tab2:
+with tab2, timed("tab2"):
     st.subheader("📚 إدارة المواد")
 
-    df_sub = load_subjects()
-    df_sub = df_sub[df_sub["branche"] == branch].copy()
+    df_sub = load_subjects(branch)
 
     # ✅ specs_all لازم يشمل حتى التخصّصات اللي موجودة في Subjects (باش multiselect ما يطيّحش)
-    df_tr_all = load_trainees()
+    df_tr_b = load_trainees(branch)
     specs_from_trainees = [
-        s.strip() for s in df_tr_all["specialite"].dropna().unique().tolist()
+        s.strip() for s in df_tr_b["specialite"].dropna().unique().tolist()
         if str(s).strip()
     ]
-    df_sub_all_for_specs = load_subjects()
     specs_from_subjects = []
-    for x in df_sub_all_for_specs["specialites"].dropna().tolist():
+    for x in df_sub["specialites"].dropna().tolist():
         parts = [p.strip() for p in str(x).split(",") if p.strip()]
         specs_from_subjects.extend(parts)
     specs_all = sorted(set(specs_from_trainees + specs_from_subjects))
@@ -563,7 +1463,7 @@ with tab2:
                 "heures_semaine": str(heures_week),
             }
             try:
-                append_record(SUBJECTS_SHEET, SUBJECTS_COLS, rec)
+                append_record(SUBJECTS_SHEET, SUBJECTS_COLS, rec, branch)
                 st.success("✅ تم إضافة المادة.")
                 st.rerun()
             except Exception as e:
@@ -612,7 +1512,7 @@ with tab2:
                         "heures_semaine": str(new_week),
                         "specialites": ",".join(new_specs),
                     }
-                    update_record_fields_by_id(SUBJECTS_SHEET, SUBJECTS_COLS, sid, updates)
+                    update_record_fields_by_id(SUBJECTS_SHEET, SUBJECTS_COLS, sid, updates, branch)
                     st.success("✅ تم تعديل المادة.")
                     st.rerun()
                 except Exception as e:
@@ -626,7 +1526,7 @@ with tab2:
                 try:
                     idxd = int(pick_del.split("]")[0].replace("[", "").strip())
                     sid = df_sub.iloc[idxd]["id"]
-                    delete_record_by_id(SUBJECTS_SHEET, SUBJECTS_COLS, sid)
+                    delete_record_by_id(SUBJECTS_SHEET, SUBJECTS_COLS, sid, branch)
                     st.success("✅ تم الحذف.")
                     st.rerun()
                 except Exception as e:
@@ -648,16 +1548,16 @@ with tab2:
                     st.error(f"خطأ أثناء حذف كل المواد: {e}")
 
 # ----------------- تبويب 3: الغيابات -----------------
-with tab3:
+with tab3, timed("tab3"):
     st.subheader("📅 تسجيل و تعديل و حذف الغيابات")
 
-    df_tr_all = load_trainees()
-    df_tr_b = df_tr_all[df_tr_all["branche"] == branch].copy()
+    df_tr_all = load_trainees(branch)
+    df_tr_b = df_tr_all
 
-    df_sub_all = load_subjects()
-    df_sub_b = df_sub_all[df_sub_all["branche"] == branch].copy()
+    df_sub_all = load_subjects(branch)
+    df_sub_b = df_sub_all
 
-    df_abs_all = load_absences()
+    df_abs_all = absences_frame(branch)
 
     if df_tr_b.empty:
         st.info("لا يوجد متكوّنون في هذا الفرع.")
@@ -667,13 +1567,25 @@ with tab3:
         specs_in_branch = sorted([s for s in df_tr_b["specialite"].dropna().unique() if s])
         spec_choice = st.selectbox("🔧 اختر التخصّص (لإظهار المتكوّنين)", ["(الكل)"] + specs_in_branch)
         if spec_choice != "(الكل)":
-            df_tr_b = df_tr_b[df_tr_b["specialite"] == spec_choice].copy()
+            df_tr_b = df_tr_b[df_tr_b["specialite"] == spec_choice]
 
         if df_tr_b.empty:
             st.info("لا يوجد متكوّنون بهذا التخصّص في هذا الفرع.")
         else:
             st.markdown("### ➕ إضافة غياب")
 
+            colD1, colD2 = st.columns([2, 1])
+            with colD1:
+                dup_mode = st.radio(
+                    "عند وجود غياب مكرّر (نفس المتكوّن/المادة/التاريخ)",
+                    list(DUP_MODES),
+                    format_func=DUP_MODES.get,
+                    horizontal=True,
+                    key="dup_mode",
+                )
+            with colD2:
+                dup_with_hours = st.checkbox("الساعات جزء من المفتاح", key="dup_with_hours")
+
             options_tr = [f"[{i}] {r['nom']} — {r['specialite']} ({r['telephone']})"
                           for i, (_, r) in enumerate(df_tr_b.iterrows())]
             tr_pick = st.selectbox("اختر المتكوّن", options_tr)
@@ -681,7 +1593,7 @@ with tab3:
             row_tr = df_tr_b.iloc[idx_tr]
 
             spec_tr = str(row_tr["specialite"])
-            df_sub_for_tr = df_sub_b[df_sub_b["specialites"].fillna("").str.contains(spec_tr)].copy()
+            df_sub_for_tr = df_sub_b[df_sub_b["specialites"].fillna("").str.contains(spec_tr)]
 
             if df_sub_for_tr.empty:
                 st.warning("لا توجد مواد مربوطة بهذا التخصّص. اضبط المواد في تبويب المواد.")
@@ -718,24 +1630,82 @@ with tab3:
                             "justifie": "Oui" if is_justified else "Non",
                             "commentaire": comment.strip(),
                         }
+                        key = absence_keys(pd.DataFrame([rec]), dup_with_hours).iloc[0]
+                        existing_id = absence_key_index(branch, dup_with_hours).get(key)
                         try:
-                            append_record(ABSENCES_SHEET, ABSENCES_COLS, rec)
-                            st.success("✅ تم تسجيل الغياب.")
-                            st.rerun()
+                            if existing_id and dup_mode == "skip":
+                                st.warning("⏭️ هذا الغياب مسجّل من قبل (تمّ التجاهل).")
+                            elif existing_id and dup_mode == "overwrite":
+                                update_record_fields_by_id(
+                                    ABSENCES_SHEET,
+                                    ABSENCES_COLS,
+                                    existing_id,
+                                    {k: rec[k] for k in ("heures_absence", "justifie", "commentaire")},
+                                    branch,
+                                )
+                                st.success("♻️ تم تعويض الغياب القديم.")
+                                st.rerun()
+                            else:
+                                if existing_id:
+                                    rec["commentaire"] = f"{DUP_FLAG} {rec['commentaire']}".strip()
+                                append_record(ABSENCES_SHEET, ABSENCES_COLS, rec, branch)
+                                st.success("✅ تم تسجيل الغياب.")
+                                st.rerun()
                         except Exception as e:
                             st.error(f"خطأ أثناء تسجيل الغياب: {e}")
 
+            st.markdown("---")
+            st.markdown("### 🩺 تبرير غيابات في فترة (شهادة طبية)")
+
+            labels_map_just = {
+                f"{r['nom']} — {r['specialite']} ({r['telephone']})": r["id"]
+                for _, r in df_tr_b.iterrows()
+            }
+            label_tr_just = st.selectbox("👤 المتكوّن", list(labels_map_just.keys()), key="justify_trainee")
+            trainee_id_just = labels_map_just[label_tr_just]
+            just_range = st.date_input(
+                "📅 الفترة (من — إلى)",
+                value=(date.today() - timedelta(days=7), date.today()),
+                key="justify_range",
+            )
+            df_abs_t_just = absences_to_justify(absences_frame(branch), trainee_id_just)
+            subj_names_just = df_sub_all.set_index("id")["nom_matiere"].to_dict()
+            subj_pick_just = st.multiselect(
+                "📚 المواد (فارغ ⇒ الكل)",
+                sorted(set(df_abs_t_just["subject_id"].astype(str))),
+                format_func=lambda sid: subj_names_just.get(sid, sid),
+                key="justify_subjects",
+            )
+            comment_just = st.text_input("ملاحظة", value="شهادة طبية", key="justify_comment")
+
+            if isinstance(just_range, (tuple, list)) and len(just_range) == 2:
+                rows_just = absences_to_justify(df_abs_t_just, trainee_id_just, just_range[0], just_range[1], subj_pick_just)
+                if rows_just.empty:
+                    st.info("ما فماش غيابات غير مبرّرة لهذا المتكوّن في الفترة هذي.")
+                else:
+                    st.dataframe(
+                        rows_just.assign(
+                            date=pd.to_datetime(rows_just["date"], format="mixed").dt.strftime("%Y-%m-%d"),
+                            nom_matiere=rows_just["subject_id"].astype(str).map(subj_names_just),
+                        )[["date", "nom_matiere", "heures_absence", "commentaire"]].sort_values("date"),
+                        use_container_width=True,
+                    )
+                    if st.button(f"🩺 برّر {len(rows_just)} غياب(ات)", key="justify_apply"):
+                        try:
+                            n = justify_absences(branch, rows_just, comment_just)
+                            st.success(f"✅ تم تبرير {n} غياب(ات).")
+                            st.rerun()
+                        except Exception as e:
+                            st.error(f"خطأ أثناء التبرير: {e}")
+
             st.markdown("---")
             st.markdown("### ✏️ تعديل / 🗑️ حذف غياب مفرد")
 
-            df_abs_all = load_absences()
+            df_abs_all = absences_frame(branch)
             if df_abs_all.empty:
                 st.info("لا توجد غيابات مسجلة بعد.")
             else:
-                df_abs = df_abs_all.copy()
-                df_abs["heures_absence_f"] = df_abs["heures_absence"].apply(as_float)
-
-                df_abs = df_abs.merge(
+                df_abs = df_abs_all.assign(heures_absence_f=hours_col(df_abs_all["heures_absence"])).merge(
                     df_tr_all[["id", "nom", "branche", "specialite", "telephone"]],
                     left_on="trainee_id",
                     right_on="id",
@@ -750,11 +1720,11 @@ with tab3:
                     suffixes=("", "_sub"),
                 )
 
-                df_abs = df_abs[df_abs["branche"] == branch].copy()
                 if df_abs.empty:
                     st.info("لا توجد غيابات في هذا الفرع.")
                 else:
-                    df_abs["date_dt"] = pd.to_datetime(df_abs["date"], errors="coerce")
+                    df_abs["date_dt"] = df_abs["date"]
+                    df_abs["date"] = df_abs["date_dt"].dt.strftime("%Y-%m-%d").fillna("?")
                     df_abs = df_abs.sort_values("date_dt", ascending=False).reset_index(drop=True)
 
                     options_abs_edit = [
@@ -794,7 +1764,7 @@ with tab3:
                                     "justifie": new_just,
                                     "commentaire": new_comment.strip(),
                                 }
-                                update_record_fields_by_id(ABSENCES_SHEET, ABSENCES_COLS, aid, updates)
+                                update_record_fields_by_id(ABSENCES_SHEET, ABSENCES_COLS, aid, updates, branch)
                                 st.success("✅ تم تعديل الغياب.")
                                 st.rerun()
                             except Exception as e:
@@ -803,7 +1773,7 @@ with tab3:
                         if delete_abs:
                             try:
                                 aid = row_a["id_x"] if "id_x" in row_a else row_a["id"]
-                                delete_record_by_id(ABSENCES_SHEET, ABSENCES_COLS, aid)
+                                delete_record_by_id(ABSENCES_SHEET, ABSENCES_COLS, aid, branch)
                                 st.success("✅ تم حذف الغياب.")
                                 st.rerun()
                             except Exception as e:
@@ -812,13 +1782,13 @@ with tab3:
             st.markdown("---")
             st.markdown("### 🗑️ حذف مجموعة غيابات (Bulk)")
 
-            df_abs_all = load_absences()
+            df_abs_all = absences_frame(branch)
             if df_abs_all.empty:
                 st.info("لا توجد غيابات للحذف.")
             else:
                 specs_bulk = sorted([s for s in df_tr_b["specialite"].dropna().unique() if s])
                 spec_bulk = st.selectbox("🔧 التخصّص (للحذف الجماعي)", ["(الكل)"] + specs_bulk)
-                df_tr_bulk = df_tr_b.copy()
+                df_tr_bulk = df_tr_b
                 if spec_bulk != "(الكل)":
                     df_tr_bulk = df_tr_bulk[df_tr_bulk["specialite"] == spec_bulk]
 
@@ -832,7 +1802,7 @@ with tab3:
                     label_tr_bulk = st.selectbox("👤 اختر المتكوّن", list(labels_map_bulk.keys()))
                     trainee_id_bulk = labels_map_bulk[label_tr_bulk]
 
-                    df_abs_t_bulk = df_abs_all[df_abs_all["trainee_id"] == trainee_id_bulk].copy()
+                    df_abs_t_bulk = df_abs_all[df_abs_all["trainee_id"] == trainee_id_bulk]
                     if df_abs_t_bulk.empty:
                         st.info("لا توجد غيابات لهذا المتكوّن.")
                     else:
@@ -858,8 +1828,7 @@ with tab3:
                         else:
                             if st.button("🗑️ حذف كل الغيابات في هذه الفترة"):
                                 try:
-                                    df_abs_t_bulk["date_dt"] = pd.to_datetime(df_abs_t_bulk["date"], errors="coerce")
-                                    mask = (df_abs_t_bulk["date_dt"].dt.date >= d_from_bulk) & (df_abs_t_bulk["date_dt"].dt.date <= d_to_bulk)
+                                    mask = (df_abs_t_bulk["date"].dt.date >= d_from_bulk) & (df_abs_t_bulk["date"].dt.date <= d_to_bulk)
                                     if sub_bulk != "(الكل)":
                                         mask &= (df_abs_t_bulk["nom_matiere"] == sub_bulk)
 
@@ -868,7 +1837,7 @@ with tab3:
                                         st.info("لا توجد غيابات مطابقة للحذف.")
                                     else:
                                         for _, rdel in to_del.iterrows():
-                                            delete_record_by_id(ABSENCES_SHEET, ABSENCES_COLS, rdel["id"])
+                                            delete_record_by_id(ABSENCES_SHEET, ABSENCES_COLS, rdel["id"], branch)
                                         st.success(f"✅ تم حذف {len(to_del)} غياب(ات).")
                                         st.rerun()
                                 except Exception as e:
@@ -891,159 +1860,120 @@ with tab3:
             st.download_button("⬇️ تحميل نموذج CSV فارغ", data=tmpl_csv, file_name="absences_template.csv", mime="text/csv")
 
             uploaded = st.file_uploader("حمّل ملف الغيابات (CSV أو Excel)", type=["csv", "xlsx"])
-            if uploaded is not None:
+            if uploaded is not None and st.button("📥 استيراد الملف"):
+                prog = st.progress(0.0, text="جاري الاستيراد...")
                 try:
-                    if uploaded.name.lower().endswith(".xlsx"):
-                        df_up = pd.read_excel(uploaded)
-                    else:
-                        df_up = pd.read_csv(uploaded)
-
-                    req_cols = {"trainee_id", "subject_id", "date", "heures_absence"}
-                    if not req_cols.issubset(set(df_up.columns)):
-                        st.error(f"❌ الملف لازم يحتوي الأعمدة: {', '.join(req_cols)}")
-                    else:
-                        count_ok = 0
-                        for _, r in df_up.iterrows():
-                            try:
-                                rec = {
-                                    "id": uuid.uuid4().hex[:10],
-                                    "trainee_id": str(r["trainee_id"]).strip(),
-                                    "subject_id": str(r["subject_id"]).strip(),
-                                    "date": str(r["date"]).split()[0],
-                                    "heures_absence": str(r["heures_absence"]),
-                                    "justifie": "Oui" if str(r.get("justifie", "Non")).strip() == "Oui" else "Non",
-                                    "commentaire": str(r.get("commentaire", "")).strip(),
-                                }
-                                append_record(ABSENCES_SHEET, ABSENCES_COLS, rec)
-                                count_ok += 1
-                            except Exception:
-                                continue
-                        st.success(f"✅ تم استيراد {count_ok} غياب(ات) من الملف.")
-                        st.rerun()
+                    res = import_absences_file(
+                        uploaded,
+                        branch,
+                        trainee_ids=set(df_tr_all["id"]),
+                        subject_ids=set(df_sub_all["id"]),
+                        dup_index=absence_key_index(branch, dup_with_hours),
+                        dup_mode=dup_mode,
+                        with_hours=dup_with_hours,
+                        on_progress=lambda p, n_ok, n_rej: prog.progress(
+                            p, text=f"جاري الاستيراد... ✅ {n_ok} | ❌ {n_rej}"
+                        ),
+                    )
+                    st.session_state[f"import_report::{branch}"] = res
                 except Exception as e:
                     st.error(f"❌ خطأ أثناء قراءة الملف: {e}")
 
+            res = st.session_state.get(f"import_report::{branch}")
+            if res:
+                st.success(f"✅ تم استيراد {res['ok']} غياب(ات) من الملف.")
+                if res["updated"]:
+                    st.info(f"♻️ تم تعويض {res['updated']} غياب(ات) موجودة.")
+                if res["rejected"]:
+                    st.warning(f"⚠️ {res['rejected']} سطر(ات) مرفوضة.")
+                    st.dataframe(res["rejects"].head(200), use_container_width=True)
+                    st.download_button(
+                        "⬇️ تحميل تقرير الرفض (CSV)",
+                        data=res["rejects"].to_csv(index=False).encode("utf-8-sig"),
+                        file_name="absences_import_rejects.csv",
+                        mime="text/csv",
+                    )
+
 # ----------------- تبويب 4: تجاوز 10٪ + واتساب -----------------
-with tab4:
+with tab4, timed("tab4"):
     st.subheader("🚨 اللي فاتو 10٪ غيابات (غير مبرّرة) + 💬 زر واتساب")
 
-    df_tr_all = load_trainees()
-    df_tr_b = df_tr_all[df_tr_all["branche"] == branch].copy()
-
-    df_sub_all = load_subjects()
-    df_sub_b = df_sub_all[df_sub_all["branche"] == branch].copy()
-
-    df_abs_all = load_absences()
+    df_tr_b = load_trainees(branch)
+    df_sub_b = load_subjects(branch)
+    # 10٪ تتحسب كان على السنة الدراسية الحالية
+    df_abs_all = in_current_year(absences_frame(branch), "date")
+    st.caption(f"السنة الدراسية: {current_academic_year()}")
 
     if df_tr_b.empty or df_sub_b.empty or df_abs_all.empty:
         st.info("يلزم يكون فما متكوّنين + مواد + غيابات باش تظهر القائمة.")
     else:
-        df_abs = df_abs_all.merge(
-            df_tr_b[["id", "nom", "specialite", "telephone", "tel_parent"]],
-            left_on="trainee_id",
-            right_on="id",
-            how="inner",
-            suffixes=("", "_tr"),
-        ).merge(
-            df_sub_b[["id", "nom_matiere", "heures_totales"]],
-            left_on="subject_id",
-            right_on="id",
-            how="inner",
-            suffixes=("", "_sub"),
-        )
+        grp = branch_unjustified(branch)
 
-        if df_abs.empty:
-            st.info("لا توجد غيابات لهذا الفرع.")
+        if grp.empty:
+            st.info("ما فماش غيابات غير مبرّرة (حسب الداتا الحالية).")
         else:
-            df_abs["heures_absence_f"] = df_abs["heures_absence"].apply(as_float)
-            df_abs["heures_totales_f"] = df_abs["heures_totales"].apply(as_float)
-
-            df_eff = df_abs[(df_abs["justifie"] != "Oui") & (df_abs["heures_totales_f"] > 0)].copy()
+            exceeded = exceedances(grp)
 
-            if df_eff.empty:
-                st.info("ما فماش غيابات غير مبرّرة (حسب الداتا الحالية).")
+            st.markdown("### ✅ قائمة اللي فاتو حدّ 10٪ (غيابات غير مبرّرة)")
+            if exceeded.empty:
+                st.success("💚 ما فما حد فاتو 10٪ توّا.")
             else:
-                grp = df_eff.groupby(["trainee_id", "subject_id"], as_index=False).agg(
-                    total_abs=("heures_absence_f", "sum"),
-                    nom=("nom", "first"),
-                    matiere=("nom_matiere", "first"),
-                    tel=("telephone", "first"),
-                    tel_parent=("tel_parent", "first"),
-                    heures_tot=("heures_totales_f", "first"),
+                st.dataframe(
+                    exceeded.rename(columns={
+                        "nom": "المتكوّن",
+                        "matiere": "المادة",
+                        "total_abs": "مجموع الغياب غير المبرر",
+                        "excess": "تجاوز بـ",
+                    })[["المتكوّن", "المادة", "مجموع الغياب غير المبرر", "تجاوز بـ"]],
+                    use_container_width=True,
                 )
-                grp["limit_10"] = grp["heures_tot"] * 0.10
-                grp["excess"] = grp["total_abs"] - grp["limit_10"]
 
-                exceeded = grp[grp["excess"] > 0].copy()
-                exceeded["total_abs"] = exceeded["total_abs"].round(2)
-                exceeded["excess"] = exceeded["excess"].round(2)
-                exceeded = exceeded.sort_values("excess", ascending=False).reset_index(drop=True)
-
-                st.markdown("### ✅ قائمة اللي فاتو حدّ 10٪ (غيابات غير مبرّرة)")
-                if exceeded.empty:
-                    st.success("💚 ما فما حد فاتو 10٪ توّا.")
-                else:
-                    st.dataframe(
-                        exceeded.rename(columns={
-                            "nom": "المتكوّن",
-                            "matiere": "المادة",
-                            "total_abs": "مجموع الغياب غير المبرر",
-                            "excess": "تجاوز بـ",
-                        })[["المتكوّن", "المادة", "مجموع الغياب غير المبرر", "تجاوز بـ"]],
-                        use_container_width=True,
+                st.markdown("---")
+                colA, colB = st.columns([2, 1])
+                with colA:
+                    target = st.radio("المرسل إليه", ["المتكوّن", "الولي"], horizontal=True, key="exceed_target")
+                with colB:
+                    remedial_month = st.selectbox("شهر التدارك", ["جويلية", "أوت"], key="remedial_month")
+
+                st.caption("زر واتساب قدّام كل متكوّن (الرسالة مختصرة كيما طلبت). "
+                           "بعد الإرسال اضغط ✅ باش يتسجّل في سجل الإشعارات.")
+
+                for i, r in exceeded.iterrows():
+                    phone_target = r["tel"] if target == "المتكوّن" else r["tel_parent"]
+                    phone_target = normalize_phone(phone_target)
+                    if not phone_target:
+                        continue
+
+                    # ✅ الرسالة المختصرة
+                    msg = exceedance_message(r, remedial_month)
+                    link = wa_link(phone_target, msg)
+
+                    st.markdown(
+                        f"""
+                        <div style="margin-bottom:10px; padding:10px; border:1px solid #eee; border-radius:8px;">
+                          <b>{i+1}. {r['nom']}</b><br/>
+                          المادة: {r['matiere']} | تجاوز بـ: {float(r['excess']):.2f}h<br/>
+                          <a href="{link}" target="_blank"
+                             style="
+                                display:inline-block;
+                                margin-top:8px;
+                                padding:7px 14px;
+                                background-color:#25D366;
+                                color:white;
+                                text-decoration:none;
+                                border-radius:7px;
+                                font-weight:700;
+                                font-size:14px;
+                             ">
+                             📲 واتساب
+                          </a>
+                        </div>
+                        """,
+                        unsafe_allow_html=True,
                     )
 
-                    st.markdown("---")
-                    colA, colB = st.columns([2, 1])
-                    with colA:
-                        target = st.radio("المرسل إليه", ["المتكوّن", "الولي"], horizontal=True, key="exceed_target")
-                    with colB:
-                        remedial_month = st.selectbox("شهر التدارك", ["جويلية", "أوت"], key="remedial_month")
-
-                    st.caption("زر واتساب قدّام كل متكوّن (الرسالة مختصرة كيما طلبت).")
-
-                    for i, r in exceeded.iterrows():
-                        phone_target = r["tel"] if target == "المتكوّن" else r["tel_parent"]
-                        phone_target = normalize_phone(phone_target)
-                        if not phone_target:
-                            continue
-
-                        # ✅ الرسالة المختصرة
-                        msg = (
-                            f"👤 المتكوّن: {r['nom']}\n"
-                            f"📚 المادة: {r['matiere']}\n"
-                            f"⛔ مجموع الغياب غير المبرر: {float(r['total_abs']):.2f} ساعة\n"
-                            f"⚠️ تجاوز بـ: {float(r['excess']):.2f} ساعة\n\n"
-                            f"📌 دورة التدارك: {remedial_month}"
-                        )
-
-                        link = wa_link(phone_target, msg)
-
-                        st.markdown(
-                            f"""
-                            <div style="margin-bottom:10px; padding:10px; border:1px solid #eee; border-radius:8px;">
-                              <b>{i+1}. {r['nom']}</b><br/>
-                              المادة: {r['matiere']} | تجاوز بـ: {float(r['excess']):.2f}h<br/>
-                              <a href="{link}" target="_blank"
-                                 style="
-                                    display:inline-block;
-                                    margin-top:8px;
-                                    padding:7px 14px;
-                                    background-color:#25D366;
-                                    color:white;
-                                    text-decoration:none;
-                                    border-radius:7px;
-                                    font-weight:700;
-                                    font-size:14px;
-                                 ">
-                                 📲 واتساب
-                              </a>
-                            </div>
-                            """,
-                            unsafe_allow_html=True,
-                        )
-
-                        # تسجيل في Notifications_Log
+                    # تسجيل في Notifications_Log كان كي يتبعث فعلا (موش مع كل render)
+                    if st.button("✅ سجّل الإرسال", key=f"exceed_log::{r['trainee_id']}::{r['subject_id']}"):
                         try:
                             append_notification_log(
                                 trainee_id=str(r["trainee_id"]),
@@ -1054,47 +1984,382 @@ with tab4:
                                 period_to=date.today(),
                                 period_label=f"تجاوز 10٪ + تدارك {remedial_month}",
                             )
-                        except Exception:
-                            pass
+                            st.success("✅ تسجّل في سجل الإشعارات.")
+                        except Exception as e:
+                            st.error(f"خطأ أثناء التسجيل: {e}")
+
+    st.markdown("---")
+    st.markdown("### 📨 تقرير فترة لمتكوّن (واتساب)")
+    if df_tr_b.empty:
+        st.info("لا يوجد متكوّنون في هذا الفرع.")
+    else:
+        tr_by_id = df_tr_b.drop_duplicates("id").set_index("id")
+        colP1, colP2, colP3 = st.columns([2, 2, 1])
+        with colP1:
+            rep_tid = st.selectbox(
+                "👤 المتكوّن",
+                list(tr_by_id.index),
+                format_func=lambda t: f"{tr_by_id.at[t, 'nom']} — {tr_by_id.at[t, 'specialite']}",
+                key="report_trainee",
+            )
+        with colP2:
+            rep_range = st.date_input(
+                "📅 الفترة",
+                value=(date.today().replace(day=1), date.today()),
+                key="report_range",
+            )
+        with colP3:
+            rep_target = st.radio("المرسل إليه", ["المتكوّن", "الولي"], key="report_target")
+        rep_from, rep_to = (tuple(rep_range) + (None, None))[:2]
+        rep_to = rep_to or rep_from
+
+        if rep_from:
+            rep_label = f"{rep_from:%Y-%m-%d} → {rep_to:%Y-%m-%d}"
+            tr_row = tr_by_id.loc[rep_tid].to_dict() | {"id": rep_tid}
+            phone_rep = normalize_phone(tr_row["telephone"] if rep_target == "المتكوّن" else tr_row["tel_parent"])
+            report, cached = trainee_period_report(branch, tr_row, rep_from, rep_to, rep_label, rep_target, phone_rep)
+            msg_rep, info_rep, link_rep = report
+
+            if not msg_rep:
+                st.info(" — ".join(info_rep))
+            else:
+                st.text_area("نص الرسالة", msg_rep, height=260, disabled=True)
+                st.caption(("⚡ من الكاش — " if cached else "") + " | ".join(info_rep))
+                colS1, colS2 = st.columns(2)
+                with colS1:
+                    if link_rep:
+                        st.link_button("📲 فتح واتساب", link_rep)
+                    else:
+                        st.warning("ما فماش رقم هاتف صالح.")
+                with colS2:
+                    if st.button("✅ سجّل الإرسال", key="report_log", disabled=not link_rep):
+                        try:
+                            append_notification_log(
+                                trainee_id=str(rep_tid),
+                                phone=phone_rep,
+                                target="Trainee" if rep_target == "المتكوّن" else "Parent",
+                                branche=branch,
+                                period_from=rep_from,
+                                period_to=rep_to,
+                                period_label=rep_label,
+                            )
+                            st.success("✅ تسجّل في سجل الإشعارات.")
+                        except Exception as e:
+                            st.error(f"خطأ أثناء التسجيل: {e}")
+
+    st.markdown("---")
+    st.markdown("### ⏳ إنذار مبكر: شكون قريب يفوت 10٪")
+    st.caption("الإسقاط على أساس نسق الغياب غير المبرر منذ بداية التكوين و عدد الساعات في الأسبوع.")
+    df_proj = branch_projection(branch, branch_data_version(branch))
+    if df_proj.empty:
+        st.info("ما فماش داتا كافية للإسقاط.")
+    else:
+        risk_pick = st.multiselect(
+            "الحالة",
+            list(RISK_LABELS.values()),
+            default=[RISK_LABELS["risk"], RISK_LABELS["watch"]],
+            key="risk_filter",
+        )
+        df_risk = df_proj[df_proj["status"].isin(risk_pick)]
+        st.dataframe(
+            df_risk.rename(columns={
+                "status": "الحالة",
+                "nom": "المتكوّن",
+                "matiere": "المادة",
+                "total_abs": "غياب غير مبرر",
+                "remaining": "الباقي قبل 10٪",
+                "weekly_abs": "نسق الغياب (س/أسبوع)",
+                "breach_date": "تاريخ التجاوز المتوقّع",
+                "course_end": "نهاية المادة",
+            })[["الحالة", "المتكوّن", "المادة", "غياب غير مبرر", "الباقي قبل 10٪",
+                "نسق الغياب (س/أسبوع)", "تاريخ التجاوز المتوقّع", "نهاية المادة"]],
+            use_container_width=True,
+        )
 
 # ----------------- تبويب 5: سجل الإشعارات -----------------
-with tab5:
+with tab5, timed("tab5"):
     st.subheader("📜 سجل الإشعارات المرسلة")
 
-    df_tr_all = load_trainees()
-    df_notif = load_notifications()
+    NOTIF_PAGE_SIZES = [50, 100, 250, 500]
 
-    if df_notif.empty:
-        st.info("ما زال ما تمّ تسجيل حتى إشعار مرسل.")
+    df_idx = branch_notifications_index(branch, data_version(branch_sheet(NOTIF_LOG_SHEET, branch)))
+
+    if df_idx.empty:
+        st.info("ما فماش إشعارات مسجلة لهذا الفرع.")
     else:
-        df_notif_b = df_notif[df_notif["branche"] == branch].copy()
-        if df_notif_b.empty:
-            st.info("ما فماش إشعارات مسجلة لهذا الفرع.")
+        df_tr_b = load_trainees(branch)
+        first_day = df_idx["sent_at"].min()
+        last_day = df_idx["sent_at"].max()
+
+        c1, c2, c3 = st.columns(3)
+        with c1:
+            rng = st.date_input(
+                "الفترة",
+                value=(first_day.date(), last_day.date()) if pd.notna(first_day) else (),
+                key="notif_range",
+            )
+        with c2:
+            tr_names = df_tr_b.set_index("id")["nom"]
+            tr_pick = st.multiselect(
+                "المتكوّن",
+                sorted(df_idx["trainee_id"].unique(), key=lambda t: str(tr_names.get(t, t))),
+                format_func=lambda t: str(tr_names.get(t, t)),
+                key="notif_trainees",
+            )
+        with c3:
+            tgt_pick = st.multiselect("المرسل إليه", sorted(df_idx["target"].unique()), key="notif_targets")
+
+        # الفلترة قبل الـmerge: الفترة بـ searchsorted على الفهرس، و بعدها المتكوّن/المرسل إليه
+        d_from, d_to = (tuple(rng) + (None, None))[:2]
+        df_view = slice_sent_at(df_idx, d_from, d_to or d_from)
+        if tr_pick:
+            df_view = df_view[df_view["trainee_id"].isin(tr_pick)]
+        if tgt_pick:
+            df_view = df_view[df_view["target"].isin(tgt_pick)]
+        df_view = df_view.iloc[::-1]  # الأحدث أولا
+
+        c4, c5 = st.columns([1, 3])
+        with c4:
+            page_size = st.selectbox("سطور في الصفحة", NOTIF_PAGE_SIZES, key="notif_page_size")
+        n_pages = max(1, -(-len(df_view) // page_size))
+        with c5:
+            page = st.number_input(f"الصفحة (من {n_pages})", min_value=1, max_value=n_pages, value=1, key="notif_page")
+        page = min(int(page), n_pages)
+
+        st.caption(f"{len(df_view)} إشعار من {len(df_idx)}")
+        df_page = df_view.iloc[(page - 1) * page_size : page * page_size]
+
+        df_tr_b_small = df_tr_b[["id", "nom", "specialite"]].rename(columns={"id": "trainee_id"})
+        df_page = df_page.merge(df_tr_b_small.drop_duplicates("trainee_id"), on="trainee_id", how="left")
+        df_page["تاريخ الإرسال"] = df_page["sent_at"].dt.strftime("%Y-%m-%d %H:%M").fillna(df_page["sent_at_iso"])
+
+        df_page = df_page.rename(
+            columns={
+                "nom": "المتكوّن",
+                "specialite": "التخصّص",
+                "phone": "الهاتف",
+                "target": "المرسل إليه",
+                "period_label": "الفترة",
+            }
+        )
+
+        st.dataframe(
+            df_page[["تاريخ الإرسال", "المتكوّن", "التخصّص", "الهاتف", "المرسل إليه", "الفترة"]],
+            use_container_width=True,
+        )
+
+# ----------------- تبويب 6: الأرشيف -----------------
+with tab6, timed("tab6"):
+    st.subheader("🗄️ أرشيف السنوات الدراسية")
+    st.caption(f"السنة الحالية: {current_academic_year()} — الشيتات اليومية تبقى فيها كان السنة هذي.")
+
+    st.markdown("### 📦 أرشفة السنوات المغلقة")
+    st.info("الغيابات و الإشعارات متاع السنوات اللي فاتت يتنقلو لشيتات أرشيف منفصلة (مثال: Absences_MB_2024-2025).")
+    confirm_arch = st.checkbox("أنا متأكد نحب نأرشف السنوات المغلقة لهذا الفرع", key="confirm_archive")
+    if st.button("📦 أرشفة الآن"):
+        if not confirm_arch:
+            st.error("لازم تعمل ✅ تأكيد قبل الأرشفة.")
         else:
-            df_tr_all_small = df_tr_all[["id", "nom", "specialite"]].rename(columns={"id": "trainee_id"})
-            df_notif_b = df_notif_b.merge(df_tr_all_small, on="trainee_id", how="left")
+            try:
+                moved_abs = archive_closed_years(ABSENCES_SHEET, ABSENCES_COLS, branch)
+                moved_notif = archive_closed_years(NOTIF_LOG_SHEET, NOTIF_LOG_COLS, branch)
+                if not moved_abs and not moved_notif:
+                    st.info("ما فماش سطور متاع سنوات مغلقة للأرشفة.")
+                else:
+                    for y, n in moved_abs.items():
+                        st.success(f"✅ {y}: تم أرشفة {n} غياب(ات).")
+                    for y, n in moved_notif.items():
+                        st.success(f"✅ {y}: تم أرشفة {n} إشعار(ات).")
+            except Exception as e:
+                st.error(f"خطأ أثناء الأرشفة: {e}")
 
-            def fmt_ts(x: str) -> str:
-                try:
-                    dt = datetime.fromisoformat(x)
-                    return dt.strftime("%Y-%m-%d %H:%M")
-                except Exception:
-                    return x
+    st.markdown("---")
+    st.markdown("### 📚 تقارير السنوات السابقة")
+    years_arch = sorted(
+        set(list_archive_years(ABSENCES_SHEET, branch)) | set(list_archive_years(NOTIF_LOG_SHEET, branch)),
+        reverse=True,
+    )
+    if not years_arch:
+        st.info("ما فماش أرشيف لهذا الفرع.")
+    else:
+        year_pick = st.selectbox("اختر السنة", years_arch, key="archive_year_pick")
+        if st.button("📂 عرض الأرشيف", key="archive_show"):
+            st.session_state["archive_year_open"] = year_pick
+
+        if st.session_state.get("archive_year_open") == year_pick:
+            df_abs_arch = load_archive(ABSENCES_SHEET, ABSENCES_COLS, branch, year_pick)
+            if df_abs_arch.empty:
+                st.info("الأرشيف فارغ.")
+            else:
+                df_tr_b = load_trainees(branch)
+                df_sub_b = load_subjects(branch)
+                df_arch = df_abs_arch.merge(
+                    df_tr_b[["id", "nom", "specialite"]],
+                    left_on="trainee_id",
+                    right_on="id",
+                    how="left",
+                    suffixes=("", "_tr"),
+                ).merge(
+                    df_sub_b[["id", "nom_matiere", "heures_totales"]],
+                    left_on="subject_id",
+                    right_on="id",
+                    how="left",
+                    suffixes=("", "_sub"),
+                )
+                df_arch["heures_absence_f"] = df_arch["heures_absence"].apply(as_float)
 
-            df_notif_b["تاريخ الإرسال"] = df_notif_b["sent_at_iso"].apply(fmt_ts)
-            df_notif_b = df_notif_b.sort_values("sent_at_iso", ascending=False).reset_index(drop=True)
+                df_eff_arch = df_arch[df_arch["justifie"] != "Oui"]
+                summary = df_eff_arch.groupby(["nom", "nom_matiere"], as_index=False).agg(
+                    total_abs=("heures_absence_f", "sum"),
+                    heures_tot=("heures_totales", "first"),
+                )
+                summary["limit_10"] = summary["heures_tot"].apply(as_float) * 0.10
+                summary["excess"] = (summary["total_abs"] - summary["limit_10"]).round(2)
+
+                st.markdown(f"#### 📊 ملخّص الغيابات غير المبرّرة — {year_pick}")
+                st.dataframe(
+                    summary.rename(columns={
+                        "nom": "المتكوّن",
+                        "nom_matiere": "المادة",
+                        "total_abs": "مجموع الغياب غير المبرر",
+                        "excess": "تجاوز بـ",
+                    })[["المتكوّن", "المادة", "مجموع الغياب غير المبرر", "تجاوز بـ"]],
+                    use_container_width=True,
+                )
 
-            df_notif_b = df_notif_b.rename(
-                columns={
-                    "nom": "المتكوّن",
+                st.markdown("#### 📋 تفاصيل الغيابات")
+                st.dataframe(
+                    df_arch[["date", "nom", "specialite", "nom_matiere", "heures_absence", "justifie", "commentaire"]]
+                    .sort_values("date", ascending=False),
+                    use_container_width=True,
+                )
+
+            df_notif_arch = load_archive(NOTIF_LOG_SHEET, NOTIF_LOG_COLS, branch, year_pick)
+            st.markdown(f"#### 📜 الإشعارات المرسلة — {year_pick}")
+            if df_notif_arch.empty:
+                st.info("ما فماش إشعارات في أرشيف هذي السنة.")
+            else:
+                st.dataframe(
+                    df_notif_arch.sort_values("sent_at_iso", ascending=False)[
+                        ["sent_at_iso", "trainee_id", "phone", "target", "period_label"]
+                    ],
+                    use_container_width=True,
+                )
+
+    st.markdown("---")
+    st.markdown("### ⬇️ Export كامل للفرع")
+    st.caption("كل الغيابات (السنة الحالية + الأرشيف) مع المتكوّن، المادة و حالة 10٪ متاع كل سنة.")
+    exp_fmt = st.radio("الصيغة", list(EXPORT_FORMATS), horizontal=True, key="export_fmt", format_func=str.upper)
+    exp_path = export_path(branch, exp_fmt)
+    if not os.path.exists(exp_path) and st.button("⚙️ حضّر الملف", key="export_build"):
+        try:
+            with st.spinner("جاري تحضير الملف..."):
+                exp_path = build_export(branch, exp_fmt)
+        except ImportError as e:
+            st.error(f"❌ الصيغة {exp_fmt.upper()} تحتاج مكتبة غير مثبّتة: {e.name}")
+        except Exception as e:
+            st.error(f"خطأ أثناء التحضير: {e}")
+    if os.path.exists(exp_path):
+        # callable ⇒ الملف يتقرا كان وقت الكليك، موش في كل rerun و كل جلسة
+        st.download_button(
+            f"⬇️ تحميل {exp_fmt.upper()} ({os.path.getsize(exp_path) / 1e6:.1f} MB)",
+            data=pathlib.Path(exp_path).read_bytes,
+            file_name=f"absences_{branch_code(branch)}_{date.today():%Y%m%d}.{exp_fmt}",
+            mime=EXPORT_FORMATS[exp_fmt],
+            key="export_download",
+        )
+
+# ----------------- تبويب 7: إحصائيات -----------------
+with tab7, timed("tab7"):
+    st.subheader("📈 إحصائيات الغيابات")
+
+    cube = branch_rollups(branch)
+    gran = st.radio("التجميع", ["أسبوعي", "شهري"], horizontal=True, key="rollup_period")
+    period = "week" if gran == "أسبوعي" else "month"
+    df_cube = cube.cube(period)
+
+    if df_cube.empty:
+        st.info("ما فماش غيابات لهذا الفرع.")
+    else:
+        c1, c2 = st.columns(2)
+        with c1:
+            spec_pick = st.multiselect("التخصّص", sorted(df_cube["specialite"].unique()), key="rollup_spec")
+        with c2:
+            mat_pick = st.multiselect("المادة", sorted(df_cube["matiere"].unique()), key="rollup_mat")
+        if spec_pick:
+            df_cube = df_cube[df_cube["specialite"].isin(spec_pick)]
+        if mat_pick:
+            df_cube = df_cube[df_cube["matiere"].isin(mat_pick)]
+
+        st.markdown("#### ⏱️ ساعات الغياب عبر الزمن")
+        trend = df_cube.pivot_table(index=period, columns="justifie", values="heures", aggfunc="sum", fill_value=0)
+        trend.index = trend.index.astype(str)
+        st.line_chart(trend)
+
+        c3, c4 = st.columns(2)
+        with c3:
+            st.markdown("#### 📚 حسب المادة")
+            st.bar_chart(df_cube.groupby("matiere")["heures"].sum().sort_values(ascending=False))
+        with c4:
+            st.markdown("#### 🎓 حسب التخصّص")
+            st.bar_chart(df_cube.groupby("specialite")["heures"].sum().sort_values(ascending=False))
+
+        with st.expander("📋 الجدول المجمّع"):
+            st.dataframe(
+                df_cube.sort_values(period, ascending=False).rename(columns={
+                    period: "الفترة",
                     "specialite": "التخصّص",
-                    "phone": "الهاتف",
-                    "target": "المرسل إليه",
-                    "period_label": "الفترة",
-                }
+                    "matiere": "المادة",
+                    "justifie": "مبرر؟",
+                    "heures": "الساعات",
+                    "absences": "عدد الغيابات",
+                })[["الفترة", "التخصّص", "المادة", "مبرر؟", "الساعات", "عدد الغيابات"]],
+                use_container_width=True,
             )
 
+
+# ================== Sidebar: Profiling (admin) ==================
+def admin_password() -> str:
+    try:
+        return str(st.secrets.get("admin_password", ""))
+    except Exception:
+        return ""
+
+
+if admin_password():
+    with st.sidebar.expander("🛠️ Profiling (admin)"):
+        if not st.session_state.get("admin_ok"):
+            admin_try = st.text_input("🔐 كلمة سرّ الأدمين", type="password", key="admin_pw_try")
+            if st.button("دخول", key="admin_login"):
+                if admin_try == admin_password():
+                    st.session_state["admin_ok"] = True
+                    st.rerun()
+                else:
+                    st.error("كلمة سرّ غير صحيحة ❌")
+        else:
+            m = metrics()
+            st.metric("📡 Sheets API calls (الجلسة هذي)", m.session_calls(session_id()))
+            st.markdown("**Sheets API (حسب العملية و الشيت)**")
+            st.dataframe(m.api_table(), use_container_width=True)
+            st.markdown("**توقيت الأقسام و الـloaders**")
+            st.dataframe(m.section_table(), use_container_width=True)
+            st.markdown("**📨 كاش تقارير الفترة**")
+            st.json(report_cache().stats())
+            st.markdown(f"**🧠 الذاكرة — غيابات {branch}**")
             st.dataframe(
-                df_notif_b[["تاريخ الإرسال", "المتكوّن", "التخصّص", "الهاتف", "المرسل إليه", "الفترة"]],
+                memory_report({"Absences (compact)": absences_frame(branch)}),
                 use_container_width=True,
             )
+            st.download_button(
+                "⬇️ تحميل الـlogs (JSONL)",
+                data=m.export_jsonl().encode("utf-8"),
+                file_name="attendancehub_metrics.jsonl",
+                mime="application/json",
+            )
+            if st.button("♻️ تصفير العدّادات", key="metrics_reset"):
+                m.reset()
+                st.rerun()
+
+
+# ================== _Meta: token وحدة لكل شيت تبدّل في الـrun ==================
+flush_meta()
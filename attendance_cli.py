@@ -0,0 +1,123 @@
+# attendance_cli.py
+# حساب تجاوزات 10٪ و تقارير الفترة لكل الفروع بلا Streamlit (مثلا cron كل ليلة).
+# النتايج (CSV/Parquet + روابط wa.me جاهزة) تتكتب في فولدر باش الإدارة تحلّها الصباح.
+#
+# مثال:
+#   python attendance_cli.py --service-account service_account.json --sheet-id XXXX \
+#       --out reports/ --workers 4 --from 2026-10-01 --to 2026-10-31
+
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, datetime
+
+import pandas as pd
+
+from attendance_engine import (
+    DEFAULT_BRANCHES,
+    Instrumented,
+    Metrics,
+    branch_reports,
+    load_branch_frames,
+    split_by_specialty,
+)
+
+SCOPE = ["https://www.googleapis.com/auth/spreadsheets"]
+
+
+def parse_branches(values: list[str] | None) -> dict[str, str]:
+    # --branch "Menzel Bourguiba=MB" --branch "Bizerte=BZ"
+    if not values:
+        return dict(DEFAULT_BRANCHES)
+    out = {}
+    for v in values:
+        name, _, code = v.partition("=")
+        if not code:
+            raise SystemExit(f"❌ صيغة الفرع لازم تكون 'اسم=كود': {v}")
+        out[name.strip()] = code.strip()
+    return out
+
+
+def open_spreadsheet(service_account_file: str, sheet_id: str):
+    import gspread
+    from google.oauth2.service_account import Credentials
+
+    creds = Credentials.from_service_account_file(service_account_file, scopes=SCOPE)
+    return gspread.authorize(creds).open_by_key(sheet_id)
+
+
+def write_table(df: pd.DataFrame, out_dir: str, name: str, fmt: str) -> str:
+    path = os.path.join(out_dir, f"{name}.{fmt}")
+    if fmt == "parquet":
+        df.to_parquet(path, index=False)
+    else:
+        df.to_csv(path, index=False, encoding="utf-8-sig")
+    return path
+
+
+def run(args) -> int:
+    branches = parse_branches(args.branch)
+    d_from = datetime.strptime(args.date_from, "%Y-%m-%d").date() if args.date_from else date.today().replace(day=1)
+    d_to = datetime.strptime(args.date_to, "%Y-%m-%d").date() if args.date_to else date.today()
+    period_label = args.period_label or f"{d_from:%Y-%m-%d} → {d_to:%Y-%m-%d}"
+    os.makedirs(args.out, exist_ok=True)
+
+    t0 = time.time()
+    m = Metrics()
+    sh = Instrumented(open_spreadsheet(args.service_account, args.sheet_id), m)
+
+    # القراءة من Google في الـprocess الرئيسي (I/O)، والحساب يتوزّع على (فرع، تخصّص)
+    tasks = []
+    for name, code in branches.items():
+        try:
+            frames = load_branch_frames(sh, code, name)
+        except LookupError as e:
+            # خير من تقارير فارغة و exit 0: الـcron يبان فاشل
+            print(f"❌ {name} ({code}): {e}", file=sys.stderr)
+            return 1
+        parts = (split_by_specialty(frames) if args.workers > 1 else {}) or {"": frames}
+        for part in parts.values():
+            tasks.append((code, (part, name, d_from, d_to, period_label, args.remedial_month)))
+        print(f"📥 {name} ({code}): {len(frames['trainees'])} متكوّن، {len(frames['absences'])} غياب")
+
+    if args.workers > 1:
+        with ProcessPoolExecutor(max_workers=args.workers) as pool:
+            futures = [(code, pool.submit(branch_reports, *task_args)) for code, task_args in tasks]
+            results = [(code, f.result()) for code, f in futures]
+    else:
+        results = [(code, branch_reports(*task_args)) for code, task_args in tasks]
+
+    stamp = date.today().strftime("%Y-%m-%d")
+    for code in branches.values():
+        exceeded = [r[0] for c, r in results if c == code]
+        reports = [r[1] for c, r in results if c == code]
+        df_exc = pd.concat(exceeded, ignore_index=True).sort_values("excess", ascending=False)
+        df_rep = pd.concat(reports, ignore_index=True)
+        p1 = write_table(df_exc, args.out, f"exceedances_{code}_{stamp}", args.format)
+        p2 = write_table(df_rep, args.out, f"period_reports_{code}_{d_from:%Y%m%d}_{d_to:%Y%m%d}", args.format)
+        print(f"✅ {code}: {len(df_exc)} تجاوز ⇒ {p1}")
+        print(f"✅ {code}: {len(df_rep)} تقرير ⇒ {p2}")
+
+    print(f"⏱️ {time.time() - t0:.1f}s — {int(m.api_table()['calls'].sum())} Sheets API calls")
+    return 0
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="AttendanceHub batch: تجاوزات 10٪ + تقارير الفترة لكل الفروع")
+    parser.add_argument("--service-account", default="service_account.json", help="ملف service account (JSON)")
+    parser.add_argument("--sheet-id", required=True, help="SPREADSHEET_ID")
+    parser.add_argument("--branch", action="append", help="'اسم=كود' (يتكرّر). افتراضيًا MB و BZ")
+    parser.add_argument("--from", dest="date_from", help="بداية الفترة YYYY-MM-DD (افتراضيًا أول الشهر)")
+    parser.add_argument("--to", dest="date_to", help="نهاية الفترة YYYY-MM-DD (افتراضيًا اليوم)")
+    parser.add_argument("--period-label", help="عنوان الفترة في الرسائل")
+    parser.add_argument("--remedial-month", default="جويلية", help="شهر التدارك في رسائل التجاوز")
+    parser.add_argument("--out", default="reports", help="فولدر النتايج")
+    parser.add_argument("--format", choices=["csv", "parquet"], default="csv")
+    parser.add_argument("--workers", type=int, default=1, help="عدد الـprocesses (>1 ⇒ توزيع حسب التخصّص)")
+    return run(parser.parse_args(argv))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,1127 @@
+# attendance_engine.py
+# منطق AttendanceHub بلا Streamlit: قواعد 10٪، رسائل واتساب، Import، قراءة الشيتات.
+# يستعملوه AttendanceHub.py (الواجهة) و attendance_cli.py (الحساب الليلي batch)
+
+import collections
+import json
+import logging
+import threading
+import time
+import urllib.parse
+import uuid
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+
+import pandas as pd
+
+log = logging.getLogger("attendancehub")
+
+# ================== الشيتات و الأعمدة ==================
+# معرّفين في attendance_schema (خفيف)، و متاحين من هنا زادة
+from attendance_schema import (  # noqa: E402,F401
+    ABSENCES_COLS,
+    ABSENCES_SHEET,
+    DEFAULT_BRANCHES,
+    NOTIF_LOG_COLS,
+    NOTIF_LOG_SHEET,
+    SUBJECTS_COLS,
+    SUBJECTS_SHEET,
+    TRAINEES_COLS,
+    TRAINEES_SHEET,
+    sheet_title,
+)
+
+
+# ================== Helpers ==================
+def normalize_phone(s: str) -> str:
+    digits = "".join(c for c in str(s) if c.isdigit())
+    if len(digits) == 8:
+        return "216" + digits
+    return digits
+
+
+def wa_link(number: str, message: str) -> str:
+    num = normalize_phone(number)
+    if not num:
+        return ""
+    return f"https://wa.me/{num}?text={urllib.parse.quote(message)}"
+
+
+def as_float(x) -> float:
+    try:
+        return float(str(x).replace(",", ".").strip() or 0)
+    except Exception:
+        return 0.0
+
+
+def values_to_df(vals: list[list[str]], cols: list[str]) -> pd.DataFrame:
+    if not vals or len(vals) < 2:
+        return pd.DataFrame(columns=cols)
+    return pd.DataFrame(vals[1:], columns=vals[0])
+
+
+def hours_col(s: pd.Series) -> pd.Series:
+    # نسخة vectorized من as_float: تقبل نص ("1,5") ولا أرقام (float32 متاع الـcompact)
+    if pd.api.types.is_numeric_dtype(s):
+        return s.astype("float64").fillna(0.0)
+    return pd.to_numeric(s.astype(str).str.replace(",", ".", regex=False).str.strip(),
+                         errors="coerce").fillna(0.0)
+
+
+# ================== تمثيل مضغوط (ذاكرة) ==================
+# الغيابات تتقرا من Sheets كلها نصوص (object). للحساب نخدمو بنسخة مضغوطة:
+# ids المتكوّن/المادة categorical (كود int)، الساعات float32، التاريخ datetime64.
+# النسخة هذي مشتركة بين الجلسات ⇒ read-only: فلترة/assign ايه، تبديل في البلاصة لا.
+ABSENCES_CATEGORY_COLS = ["trainee_id", "subject_id", "justifie", "commentaire"]
+
+
+def compact_absences(df: pd.DataFrame) -> pd.DataFrame:
+    out = pd.DataFrame({"id": df["id"].astype(str)}) if "id" in df else pd.DataFrame(index=df.index)
+    for c in ABSENCES_CATEGORY_COLS:
+        if c in df:
+            out[c] = df[c].fillna("").astype(str).astype("category")
+    if "date" in df:
+        out["date"] = pd.to_datetime(df["date"], errors="coerce", format="mixed")
+    if "heures_absence" in df:
+        out["heures_absence"] = hours_col(df["heures_absence"]).astype("float32")
+    return out.reset_index(drop=True)
+
+
+def frame_memory_mb(df: pd.DataFrame) -> float:
+    return float(df.memory_usage(index=True, deep=True).sum()) / 2**20
+
+
+def memory_report(frames: dict[str, pd.DataFrame]) -> pd.DataFrame:
+    # {"اسم": frame} ⇒ MB، bytes/سطر و MB لكل 100k سطر
+    rows = []
+    for name, df in frames.items():
+        mb = frame_memory_mb(df)
+        rows.append({
+            "frame": name,
+            "rows": len(df),
+            "MB": round(mb, 3),
+            "bytes/row": round(mb * 2**20 / len(df), 1) if len(df) else 0.0,
+            "MB/100k": round(mb / len(df) * 100_000, 2) if len(df) else 0.0,
+        })
+    return pd.DataFrame(rows)
+
+
+# ================== السنة الدراسية ==================
+ACADEMIC_YEAR_START_MONTH = 9  # السنة الدراسية تبدا في سبتمبر
+
+
+def academic_year_of(d: date) -> str:
+    start = d.year if d.month >= ACADEMIC_YEAR_START_MONTH else d.year - 1
+    return f"{start}-{start + 1}"
+
+
+def academic_year_bounds(year_label: str) -> tuple[date, date]:
+    start = int(year_label.split("-")[0])
+    return date(start, ACADEMIC_YEAR_START_MONTH, 1), date(start + 1, ACADEMIC_YEAR_START_MONTH, 1) - timedelta(days=1)
+
+
+def current_academic_year() -> str:
+    return academic_year_of(date.today())
+
+
+def in_current_year(df: pd.DataFrame, date_col: str) -> pd.DataFrame:
+    """
+    نخليو كان السطور متاع السنة الحالية (التواريخ اللي ما تتقراش تبقى، باش ما تضيعش)
+    """
+    if df.empty:
+        return df
+    d_from, d_to = academic_year_bounds(current_academic_year())
+    dt = pd.to_datetime(df[date_col], errors="coerce").dt.date
+    return df[dt.isna() | ((dt >= d_from) & (dt <= d_to))]
+
+
+# ================== قاعدة 10٪ ==================
+def unjustified_totals(df_tr: pd.DataFrame, df_sub: pd.DataFrame, df_abs: pd.DataFrame) -> pd.DataFrame:
+    """
+    مجموع الغياب غير المبرر لكل (متكوّن، مادة) مع حدّ 10٪ و التجاوز (excess)
+    """
+    cols = ["trainee_id", "subject_id", "total_abs", "nom", "specialite", "matiere", "tel", "tel_parent",
+            "date_debut", "heures_tot", "heures_semaine", "limit_10", "excess"]
+    if df_tr.empty or df_sub.empty or df_abs.empty:
+        return pd.DataFrame(columns=cols)
+
+    df = df_abs.merge(
+        df_tr[["id", "nom", "specialite", "telephone", "tel_parent", "date_debut"]],
+        left_on="trainee_id",
+        right_on="id",
+        how="inner",
+        suffixes=("", "_tr"),
+    ).merge(
+        df_sub[["id", "nom_matiere", "heures_totales", "heures_semaine"]],
+        left_on="subject_id",
+        right_on="id",
+        how="inner",
+        suffixes=("", "_sub"),
+    )
+    if df.empty:
+        return pd.DataFrame(columns=cols)
+
+    df["heures_absence_f"] = hours_col(df["heures_absence"])
+    df["heures_totales_f"] = hours_col(df["heures_totales"])
+    df_eff = df[(df["justifie"] != "Oui") & (df["heures_totales_f"] > 0)]
+    if df_eff.empty:
+        return pd.DataFrame(columns=cols)
+
+    grp = df_eff.groupby(["trainee_id", "subject_id"], as_index=False, observed=True).agg(
+        total_abs=("heures_absence_f", "sum"),
+        nom=("nom", "first"),
+        specialite=("specialite", "first"),
+        matiere=("nom_matiere", "first"),
+        tel=("telephone", "first"),
+        tel_parent=("tel_parent", "first"),
+        date_debut=("date_debut", "first"),
+        heures_tot=("heures_totales_f", "first"),
+        heures_semaine=("heures_semaine", "first"),
+    )
+    grp["trainee_id"] = grp["trainee_id"].astype(str)
+    grp["subject_id"] = grp["subject_id"].astype(str)
+    grp["heures_semaine"] = hours_col(grp["heures_semaine"])
+    grp["limit_10"] = grp["heures_tot"] * 0.10
+    grp["excess"] = grp["total_abs"] - grp["limit_10"]
+    return grp
+
+
+def exceedances(grp: pd.DataFrame) -> pd.DataFrame:
+    exceeded = grp[grp["excess"] > 0].copy()
+    exceeded["total_abs"] = exceeded["total_abs"].astype(float).round(2)
+    exceeded["excess"] = exceeded["excess"].astype(float).round(2)
+    return exceeded.sort_values("excess", ascending=False).reset_index(drop=True)
+
+
+def absences_to_justify(
+    df_abs: pd.DataFrame, trainee_id: str, d_from: date | None = None, d_to: date | None = None, subject_ids=None
+) -> pd.DataFrame:
+    # الغيابات غير المبرّرة متاع متكوّن في فترة (شهادة طبية) — None / subject_ids فارغ ⇒ بلا حدّ
+    if df_abs.empty:
+        return df_abs
+    m = (df_abs["trainee_id"].astype(str) == str(trainee_id)) & (df_abs["justifie"].astype(str) != "Oui")
+    if d_from is not None or d_to is not None:
+        d = pd.to_datetime(df_abs["date"], errors="coerce", format="mixed")
+        if d_from is not None:
+            m &= d >= pd.Timestamp(d_from)
+        if d_to is not None:
+            m &= d <= pd.Timestamp(d_to)
+    if subject_ids:
+        m &= df_abs["subject_id"].astype(str).isin([str(x) for x in subject_ids])
+    return df_abs[m]
+
+
+def apply_justification_delta(grp: pd.DataFrame, justified: pd.DataFrame) -> pd.DataFrame:
+    """
+    مجاميع 10٪ (unjustified_totals) بعد ما سطور معروفة ولّات مبرّرة: ننقصو ساعاتها
+    من (متكوّن، مادة) متاعها بلا ما نعاودو الحساب على الفرع الكل
+    """
+    if grp.empty or justified.empty:
+        return grp
+    minus = (
+        justified.assign(
+            trainee_id=justified["trainee_id"].astype(str),
+            subject_id=justified["subject_id"].astype(str),
+            h=hours_col(justified["heures_absence"]),
+        )
+        .groupby(["trainee_id", "subject_id"])["h"]
+        .sum()
+    )
+    out = grp.copy()
+    keys = pd.MultiIndex.from_frame(out[["trainee_id", "subject_id"]].astype(str))
+    out["total_abs"] = out["total_abs"] - minus.reindex(keys, fill_value=0.0).to_numpy()
+    out["excess"] = out["total_abs"] - out["limit_10"]
+    # نفس unjustified_totals: (متكوّن، مادة) بلا حتى غياب غير مبرّر ما يظهرش
+    return out[out["total_abs"] > 1e-9].reset_index(drop=True)
+
+
+RISK_LABELS = {
+    "exceeded": "⛔ متجاوز",
+    "risk": "🔴 خطر",
+    "watch": "🟠 مراقبة",
+    "ok": "🟢 عادي",
+}
+RISK_WATCH_RATIO = 0.30  # "مراقبة" كي يبقى أقل من 30٪ من حدّ 10٪
+
+
+def breach_projection(grp: pd.DataFrame, today: date | None = None) -> pd.DataFrame:
+    """
+    إسقاط vectorized لكل (متكوّن، مادة): الباقي قبل 10٪ و تاريخ التجاوز المتوقّع،
+    على أساس نسق الغياب غير المبرر منذ date_debut و heures_semaine.
+    """
+    cols = ["status", "trainee_id", "subject_id", "nom", "specialite", "matiere", "tel", "tel_parent",
+            "total_abs", "limit_10", "remaining", "weekly_abs", "breach_date", "course_end"]
+    if grp.empty:
+        return pd.DataFrame(columns=cols)
+    today = pd.Timestamp(today or date.today())
+    year_start = pd.Timestamp(academic_year_bounds(academic_year_of(today.date()))[0])
+
+    df = grp.copy()
+    start = pd.to_datetime(df["date_debut"], errors="coerce").fillna(year_start)
+    hs = df["heures_semaine"].astype(float).where(lambda x: x > 0)
+    course_weeks = df["heures_tot"].astype(float) / hs
+    df["course_end"] = (start + pd.to_timedelta(course_weeks * 7, unit="D")).dt.date
+
+    elapsed_weeks = ((today - start).dt.days / 7).clip(lower=1)
+    elapsed_hours = elapsed_weeks.clip(upper=course_weeks) * hs
+    df["weekly_abs"] = (df["total_abs"] / elapsed_hours * hs).round(2)
+    df["remaining"] = (df["limit_10"] - df["total_abs"]).round(2)
+
+    weeks_left = (df["remaining"].clip(lower=0) / df["weekly_abs"].where(lambda x: x > 0))
+    breach = today + pd.to_timedelta(weeks_left * 7, unit="D")
+    df["breach_date"] = breach.dt.date.where(breach.notna(), None)
+
+    before_end = breach.notna() & (breach <= pd.to_datetime(df["course_end"]))
+    df["status"] = RISK_LABELS["ok"]
+    df.loc[df["remaining"] < df["limit_10"] * RISK_WATCH_RATIO, "status"] = RISK_LABELS["watch"]
+    df.loc[before_end, "status"] = RISK_LABELS["risk"]
+    df.loc[df["remaining"] <= 0, "status"] = RISK_LABELS["exceeded"]
+    df["total_abs"] = df["total_abs"].round(2)
+
+    return df.sort_values(["breach_date", "remaining"], na_position="last").reset_index(drop=True)[cols]
+
+
+def exceedance_message(r, remedial_month: str) -> str:
+    # ✅ الرسالة المختصرة
+    return (
+        f"👤 المتكوّن: {r['nom']}\n"
+        f"📚 المادة: {r['matiere']}\n"
+        f"⛔ مجموع الغياب غير المبرر: {float(r['total_abs']):.2f} ساعة\n"
+        f"⚠️ تجاوز بـ: {float(r['excess']):.2f} ساعة\n\n"
+        f"📌 دورة التدارك: {remedial_month}"
+    )
+
+
+def build_whatsapp_message_for_trainee(
+    tr_row,
+    df_abs_all,
+    df_sub_all,
+    branch_name,
+    d_from: date,
+    d_to: date,
+    period_label: str,
+) -> tuple[str, list[str]]:
+    trainee_id = tr_row["id"]
+    df_abs_t = df_abs_all[df_abs_all["trainee_id"] == trainee_id].copy()
+
+    if df_abs_t.empty:
+        return "", ["لا توجد غيابات لهذا المتكوّن في أي فترة."]
+
+    df_abs_t["date_dt"] = pd.to_datetime(df_abs_t["date"], errors="coerce")
+    mask_period = (df_abs_t["date_dt"].dt.date >= d_from) & (df_abs_t["date_dt"].dt.date <= d_to)
+    df_abs_period = df_abs_t[mask_period].copy()
+
+    if df_abs_period.empty:
+        return "", ["لا توجد غيابات في هذه الفترة."]
+
+    df_abs_period = df_abs_period.merge(
+        df_sub_all[["id", "nom_matiere", "heures_totales"]],
+        left_on="subject_id",
+        right_on="id",
+        how="left",
+        suffixes=("", "_sub"),
+    )
+
+    detail_lines = []
+    for _, r in df_abs_period.iterrows():
+        dstr = r["date_dt"].strftime("%Y-%m-%d") if pd.notna(r["date_dt"]) else str(r["date"])
+        subj = str(r.get("nom_matiere", "") or "").strip()
+        h = as_float(r.get("heures_absence", 0))
+        just = "مبرر" if str(r.get("justifie", "")).strip() == "Oui" else "غير مبرر"
+        detail_lines.append(f"- {dstr} | {subj} | {h:.2f} ساعة ({just})")
+
+    df_eff_t = df_abs_period[df_abs_period["justifie"] != "Oui"].copy()
+    df_eff_t["heures_absence_f"] = df_eff_t["heures_absence"].apply(as_float)
+    df_eff_t["heures_totales_f"] = df_eff_t["heures_totales"].apply(as_float)
+
+    stats_lines = []
+    elim_lines = []
+
+    if not df_eff_t.empty:
+        grp_t = df_eff_t.groupby("nom_matiere", as_index=False).agg(
+            total_abs=("heures_absence_f", "sum"),
+            heures_tot=("heures_totales_f", "first"),
+        )
+        grp_t["limit_10"] = grp_t["heures_tot"] * 0.10
+        grp_t["remaining"] = grp_t["limit_10"] - grp_t["total_abs"]
+
+        for _, g in grp_t.iterrows():
+            mat_name = str(g["nom_matiere"]).strip()
+            total_abs = g["total_abs"]
+            remaining = g["remaining"]
+
+            stats_lines.append(
+                f"- {mat_name}:\n"
+                f"   • مجموع الغياب غير المبرر: {total_abs:.2f} ساعة\n"
+                f"   • الباقي قبل الإقصاء (10٪): {remaining:.2f} ساعة من مجموع الساعات الجملية"
+            )
+
+            if remaining <= 0:
+                elim_lines.append(f"- {mat_name}")
+
+    msg_lines = []
+    msg_lines.append("السلام عليكم،")
+    msg_lines.append("إدارة هيكل التكوين تحب تعلمك بتفاصيل الغيابات اللي تمّ تسجيلها في الفترة المحدّدة:")
+    msg_lines.append("")
+    msg_lines.append(f"👤 المتكوّن: {tr_row.get('nom', '')}")
+    msg_lines.append(f"🏫 الفرع: {branch_name}")
+    msg_lines.append(f"🔧 التخصّص: {tr_row.get('specialite', '')}")
+    msg_lines.append(f"🕒 الفترة: {period_label}")
+    msg_lines.append("")
+    msg_lines.append("📋 تفاصيل الغيابات في هذه الفترة:")
+    msg_lines.extend(detail_lines)
+
+    if stats_lines:
+        msg_lines.append("")
+        msg_lines.append("📊 ملخّص الغيابات غير المبررة حسب المواد:")
+        msg_lines.extend(stats_lines)
+
+    if elim_lines:
+        msg_lines.append("")
+        msg_lines.append("⚠️ تنبيه: في بعض المواد تمّ تجاوز الحد الأقصى للغيابات ويمكن يترتّب عليه الإقصاء:")
+        msg_lines.extend(elim_lines)
+
+    msg_lines.append("")
+    msg_lines.append("🙏 نشكروك على تفهّمك، ومرحبا بيك في الإدارة لأي استفسار.")
+
+    msg = "\n".join(msg_lines)
+
+    info_debug = [
+        f"غيابات في الفترة: {len(df_abs_period)}",
+        f"غيابات غير مبررة محسوبة لــ10٪: {len(df_eff_t)}",
+    ]
+    return msg, info_debug
+
+# ================== الغيابات المكرّرة ==================
+# مفتاح الغياب: trainee_id | subject_id | date (+ الساعات اختياري)
+DUP_FLAG = "⚠️ مكرّر؟"
+
+
+def absence_keys(df: pd.DataFrame, with_hours: bool = False) -> pd.Series:
+    key = (
+        df["trainee_id"].astype(str).str.strip()
+        + "|" + df["subject_id"].astype(str).str.strip()
+        + "|" + df["date"].astype(str).str.strip().str[:10]
+    )
+    if with_hours:
+        hours = pd.to_numeric(df["heures_absence"].astype(str).str.replace(",", ".", regex=False), errors="coerce")
+        key = key + "|" + hours.round(2).astype(str)
+    return key
+
+
+def apply_duplicate_policy(ok: pd.DataFrame, dup_index: dict, seen: set, mode: str, with_hours: bool):
+    """
+    يرجّع (new_rows, updates_by_id, dup_rows) حسب mode (skip / overwrite / flag)
+    seen: مفاتيح السطور متاع الـchunks السابقة في نفس الملف
+    """
+    keys = absence_keys(ok, with_hours)
+    existing_id = keys.map(dup_index)
+    in_sheet = existing_id.notna()
+    in_file = keys.duplicated() | keys.isin(seen)
+    seen.update(keys)
+
+    updates = {}
+    if mode == "flag":
+        is_dup = in_sheet | in_file
+        flagged = (DUP_FLAG + " " + ok["commentaire"]).str.strip()
+        ok = ok.assign(commentaire=ok["commentaire"].mask(is_dup, flagged))
+        return ok, updates, ok.iloc[0:0]
+
+    to_update = in_sheet & ~in_file if mode == "overwrite" else pd.Series(False, index=ok.index)
+    updates = {
+        eid: {"heures_absence": r.heures_absence, "justifie": r.justifie, "commentaire": r.commentaire}
+        for eid, r in zip(existing_id[to_update], ok[to_update].itertuples(index=False))
+    }
+    is_new = ~in_sheet & ~in_file
+    return ok[is_new], updates, ok[~is_new & ~to_update]
+
+# ================== Import (streaming + validation) ==================
+# الملف يتقرا بالـchunks (CSV: read_csv(chunksize)، Excel: openpyxl read_only)
+# وكل chunk يتفحص vectorized ضد المتكوّنين و المواد متاع الفرع.
+IMPORT_CHUNK_ROWS = 5000
+IMPORT_REQUIRED_COLS = ["trainee_id", "subject_id", "date", "heures_absence"]
+IMPORT_MAX_REJECT_ROWS = 50000  # نحدّو حجم تقرير الرفض باش الذاكرة تبقى محدودة
+
+
+def iter_upload_chunks(uploaded, chunksize: int = IMPORT_CHUNK_ROWS):
+    """
+    يرجّع (chunk, progress) — progress بين 0 و 1
+    """
+    if uploaded.name.lower().endswith(".xlsx"):
+        from openpyxl import load_workbook
+
+        wb = load_workbook(uploaded, read_only=True, data_only=True)
+        try:
+            ws = wb.active
+            total = max((ws.max_row or 1) - 1, 1)
+            rows = ws.iter_rows(values_only=True)
+            header = [str(h).strip() if h is not None else "" for h in next(rows, ())]
+            buf, done = [], 0
+            for r in rows:
+                buf.append(list(r[: len(header)]) + [None] * (len(header) - len(r)))
+                if len(buf) >= chunksize:
+                    done += len(buf)
+                    yield pd.DataFrame(buf, columns=header), min(done / total, 1.0)
+                    buf = []
+            if buf:
+                yield pd.DataFrame(buf, columns=header), 1.0
+        finally:
+            wb.close()
+    else:
+        size = max(getattr(uploaded, "size", 0) or 0, 1)
+        reader = pd.read_csv(uploaded, chunksize=chunksize, dtype=str, keep_default_na=False, skipinitialspace=True)
+        for chunk in reader:
+            chunk.columns = [str(c).strip() for c in chunk.columns]
+            yield chunk, min(uploaded.tell() / size, 1.0)
+
+
+def import_dates(s: pd.Series) -> pd.Series:
+    # خانات datetime (Excel) تبقى كيما هي؛ النص لازم YYYY-MM-DD كيما النموذج
+    # (بلا تخمين: "05/10/2026" يترفض عوض ما يتقلب 10 ماي)
+    if pd.api.types.is_datetime64_any_dtype(s):
+        return s
+    is_dt = s.map(lambda v: isinstance(v, (datetime, date)))
+    parsed = pd.to_datetime(s.where(~is_dt, "").fillna("").astype(str).str.strip(), format="%Y-%m-%d", errors="coerce")
+    if is_dt.any():
+        parsed = parsed.mask(is_dt, pd.to_datetime(s.where(is_dt), errors="coerce"))
+    return parsed
+
+
+def validate_absence_chunk(chunk: pd.DataFrame, trainee_ids: set, subject_ids: set, first_line: int):
+    """
+    يرجّع (ok, rejected): ok بأعمدة ABSENCES_COLS (+ رقم السطر) جاهز للكتابة،
+    rejected فيه السطور الأصلية + رقم السطر + سبب الرفض
+    """
+    def text(col):
+        if col not in chunk.columns:
+            return pd.Series("", index=chunk.index)
+        return chunk[col].fillna("").astype(str).str.strip()
+
+    tr = text("trainee_id")
+    sub = text("subject_id")
+    dt = import_dates(chunk["date"])
+    hours = pd.to_numeric(text("heures_absence").str.replace(",", ".", regex=False), errors="coerce")
+
+    # أول سبب يتطابق هو اللي يتسجّل
+    reasons = [
+        (~tr.isin(trainee_ids), "trainee_id غير موجود في هذا الفرع"),
+        (~sub.isin(subject_ids), "subject_id غير موجود في هذا الفرع"),
+        (dt.isna(), "تاريخ غير صالح"),
+        (hours.isna() | (hours <= 0), "عدد الساعات غير صالح"),
+    ]
+    reason = pd.Series("", index=chunk.index)
+    for mask, msg in reversed(reasons):
+        reason = reason.mask(mask, msg)
+    bad = reason != ""
+
+    good = ~bad
+    lines = first_line + pd.RangeIndex(len(chunk))
+    ok = pd.DataFrame({
+        "السطر": lines[good.to_numpy()],
+        "id": [uuid.uuid4().hex[:10] for _ in range(int(good.sum()))],
+        "trainee_id": tr[good].values,
+        "subject_id": sub[good].values,
+        "date": dt[good].dt.strftime("%Y-%m-%d").values,
+        "heures_absence": hours[good].astype(str).values,
+        "justifie": (text("justifie")[good] == "Oui").map({True: "Oui", False: "Non"}).values,
+        "commentaire": text("commentaire")[good].values,
+    })
+
+    rejected = chunk[bad].copy()
+    rejected.insert(0, "سبب الرفض", reason[bad])
+    rejected.insert(0, "السطر", lines[bad.to_numpy()])
+    return ok, rejected
+
+# ================== Import قائمة المتكوّنين ==================
+ROSTER_REQUIRED_COLS = ["nom", "telephone"]  # specialite و date_debut ينجمو يجيو من الفورم
+
+
+def normalize_phones(s: pd.Series) -> pd.Series:
+    # نسخة vectorized من normalize_phone (و "22111222.0" اللي تجي من Excel)
+    digits = (
+        s.fillna("").astype(str).str.strip()
+        .str.replace(r"\.0+$", "", regex=True)
+        .str.replace(r"\D", "", regex=True)
+    )
+    return digits.mask(digits.str.len() == 8, "216" + digits)
+
+
+def name_keys(s: pd.Series) -> pd.Series:
+    return s.fillna("").astype(str).str.casefold().str.split().str.join(" ")
+
+
+def prepare_roster(df: pd.DataFrame, existing: pd.DataFrame, branch_name: str, default_spec: str, default_date: date):
+    """
+    يرجّع (new, rejected): new بأعمدة TRAINEES_COLS (+ رقم السطر) جاهز لـappend_rows،
+    rejected فيه السطور الأصلية + رقم السطر + سبب الرفض (نفس صيغة import الغيابات)
+    """
+    df = df.reset_index(drop=True)
+
+    def text(col):
+        if col not in df.columns:
+            return pd.Series("", index=df.index)
+        return df[col].fillna("").astype(str).str.strip()
+
+    nom = text("nom").str.split().str.join(" ").fillna("")
+    tel = normalize_phones(text("telephone"))
+    tel_parent = normalize_phones(text("tel_parent"))
+    spec = text("specialite").mask(lambda x: x == "", default_spec.strip())
+    raw_date = df["date_debut"] if "date_debut" in df.columns else pd.Series("", index=df.index)
+    has_date = raw_date.fillna("").astype(str).str.strip() != ""
+    dt = pd.to_datetime(raw_date.where(has_date), errors="coerce", format="mixed")
+
+    existing_phones = set(normalize_phones(existing["telephone"])) if not existing.empty else set()
+    existing_names = set(name_keys(existing["nom"])) if not existing.empty else set()
+    keys = name_keys(nom)
+
+    # أول سبب يتطابق هو اللي يتسجّل
+    reasons = [
+        (nom == "", "الاسم ناقص"),
+        (tel.str.len() < 8, "هاتف غير صالح"),
+        (spec == "", "التخصّص ناقص"),
+        (has_date & dt.isna(), "تاريخ غير صالح"),
+        (tel.isin(existing_phones), "الهاتف موجود في هذا الفرع"),
+        (keys.isin(existing_names), "الاسم موجود في هذا الفرع"),
+        (tel.duplicated() | keys.duplicated(), "مكرّر في الملف"),
+    ]
+    reason = pd.Series("", index=df.index)
+    for mask, msg in reversed(reasons):
+        reason = reason.mask(mask, msg)
+    bad = reason != ""
+    good = ~bad
+
+    lines = 2 + pd.RangeIndex(len(df))  # السطر 1 هو الهيدر
+    new = pd.DataFrame({
+        "السطر": lines[good.to_numpy()],
+        "id": [uuid.uuid4().hex[:10] for _ in range(int(good.sum()))],
+        "nom": nom[good].values,
+        "telephone": tel[good].values,
+        "tel_parent": tel_parent[good].values,
+        "branche": branch_name,
+        "specialite": spec[good].values,
+        "date_debut": dt[good].dt.strftime("%Y-%m-%d").fillna(default_date.strftime("%Y-%m-%d")).values,
+        "actif": "1",
+    })
+
+    rejected = df[bad].copy()
+    rejected.insert(0, "سبب الرفض", reason[bad])
+    rejected.insert(0, "السطر", lines[bad.to_numpy()])
+    return new, rejected
+
+
+# ================== سجل الإشعارات ==================
+def notifications_index(df_notif: pd.DataFrame) -> pd.DataFrame:
+    """
+    السجل مرتّب حسب sent_at (datetime64) ⇒ فلترة الفترة بـ searchsorted بلا ما نعدّيو على كل السطور
+    """
+    idx = df_notif.assign(sent_at=pd.to_datetime(df_notif["sent_at_iso"], errors="coerce", format="ISO8601"))
+    return idx.sort_values("sent_at", kind="stable").reset_index(drop=True)
+
+
+def slice_sent_at(idx: pd.DataFrame, d_from: date | None, d_to: date | None) -> pd.DataFrame:
+    lo = idx["sent_at"].searchsorted(pd.Timestamp(d_from), "left") if d_from else 0
+    hi = idx["sent_at"].searchsorted(pd.Timestamp(d_to + timedelta(days=1)), "left") if d_to else len(idx)
+    return idx.iloc[lo:hi]
+
+# ================== كاش تقارير الفترة ==================
+def trainee_fingerprints(df_abs: pd.DataFrame) -> dict:
+    """
+    trainee_id -> بصمة غياباتو (مجموع hash السطور) ⇒ تتبدّل كان كي غيابات المتكوّن هذا تتبدّل
+    """
+    if df_abs.empty:
+        return {}
+    h = pd.Series(pd.util.hash_pandas_object(df_abs[ABSENCES_COLS[:6]], index=False).values)
+    return h.groupby(df_abs["trainee_id"].astype(str).values).sum().to_dict()
+
+
+class ReportCache:
+    """
+    LRU محدود للتقارير المحضّرة: (trainee_id, فترة, target) -> (بصمة، تقرير).
+    كي بصمة المتكوّن تتبدّل، التقرير القديم يتنحّى و يتعاود يتبنى (المتكوّنين الأخرين يبقاو)
+    """
+
+    def __init__(self, max_entries: int = 512):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self._data = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_build(self, key: tuple, fingerprint, build):
+        with self.lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[0] == fingerprint:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return entry[1], True
+        report = build()
+        with self.lock:
+            self._data[key] = (fingerprint, report)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+            self.misses += 1
+        return report, False
+
+    def stats(self) -> dict:
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._data),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 3) if total else 0.0,
+            }
+
+
+# ================== Rollups (إحصائيات الغياب) ==================
+# جداول مجمّعة حسب (أسبوع/شهر × تخصّص × مادة × مبرر) تتحدّث incremental:
+# كان السطور الجديدة/المبدّلة/المحذوفة تتحسب، موش الشيت كامل.
+ROLLUP_DIMS = ["specialite", "subject_id", "matiere", "justifie"]
+
+
+def absence_facts(df_abs: pd.DataFrame, df_tr: pd.DataFrame, df_sub: pd.DataFrame) -> pd.DataFrame:
+    cols = ["id", "week", "month", *ROLLUP_DIMS, "heures"]
+    if df_abs.empty:
+        return pd.DataFrame(columns=cols)
+    dt = pd.to_datetime(df_abs["date"], errors="coerce")
+    facts = pd.DataFrame({
+        "id": df_abs["id"].values,
+        "week": (dt - pd.to_timedelta(dt.dt.weekday, unit="D")).dt.date.values,
+        "month": dt.dt.to_period("M").astype(str).values,
+        "trainee_id": df_abs["trainee_id"].values,
+        "subject_id": df_abs["subject_id"].values,
+        "justifie": (df_abs["justifie"] == "Oui").map({True: "مبرر", False: "غير مبرر"}).values,
+        "heures": hours_col(df_abs["heures_absence"]).values,
+    })
+    facts = facts[dt.notna().values]
+    specs = df_tr.set_index("id")["specialite"]
+    names = df_sub.set_index("id")["nom_matiere"]
+    facts["specialite"] = facts["trainee_id"].map(specs[~specs.index.duplicated()]).fillna("")
+    facts["matiere"] = facts["subject_id"].map(names[~names.index.duplicated()]).fillna("")
+    return facts[cols]
+
+
+def rollup(facts: pd.DataFrame, period: str, sign: int = 1) -> pd.DataFrame:
+    grp = facts.groupby([period, *ROLLUP_DIMS], as_index=False, observed=True).agg(
+        heures=("heures", "sum"),
+        absences=("id", "count"),
+    )
+    grp["heures"] *= sign
+    grp["absences"] *= sign
+    return grp
+
+
+class RollupCube:
+    """
+    rollups أسبوعية و شهرية لفرع، مع update incremental حسب hash كل سطر غياب
+    """
+
+    PERIODS = ("week", "month")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.hashes = None      # id -> hash متاع السطر
+        self.dims_hash = None   # hash متاع (تخصّصات المتكوّنين، أسماء المواد)
+        self.facts = pd.DataFrame()
+        self.cubes = {}
+        self.key = None         # نسخة الداتا (من عند الـcaller) اللي تحسب عليها آخر update
+
+    @staticmethod
+    def _row_hashes(df_abs: pd.DataFrame) -> pd.Series:
+        h = pd.Series(pd.util.hash_pandas_object(df_abs[ABSENCES_COLS[:6]], index=False).values,
+                      index=df_abs["id"].values)
+        return h[~h.index.duplicated()]
+
+    @staticmethod
+    def _dims_hash(df_tr: pd.DataFrame, df_sub: pd.DataFrame) -> int:
+        return hash((pd.util.hash_pandas_object(df_tr[["id", "specialite"]], index=False).values.tobytes(),
+                     pd.util.hash_pandas_object(df_sub[["id", "nom_matiere"]], index=False).values.tobytes()))
+
+    def update(self, df_abs: pd.DataFrame, df_tr: pd.DataFrame, df_sub: pd.DataFrame, key=None):
+        with self.lock:
+            df_abs = df_abs.drop_duplicates("id")
+            hashes = self._row_hashes(df_abs)
+            dims_hash = self._dims_hash(df_tr, df_sub)
+
+            if self.hashes is None or dims_hash != self.dims_hash:
+                self.facts = absence_facts(df_abs, df_tr, df_sub)
+                self.cubes = {p: rollup(self.facts, p) for p in self.PERIODS}
+            else:
+                old = self.hashes
+                common = hashes.index.intersection(old.index)
+                modified = common[hashes[common].values != old[common].values]
+                out_ids = old.index.difference(hashes.index).union(modified)
+                in_ids = hashes.index.difference(old.index).union(modified)
+                if len(out_ids) == 0 and len(in_ids) == 0:
+                    self.key = key
+                    return
+                minus = self.facts[self.facts["id"].isin(out_ids)]
+                plus = absence_facts(df_abs[df_abs["id"].isin(in_ids)], df_tr, df_sub)
+                self.facts = pd.concat([self.facts[~self.facts["id"].isin(out_ids)], plus], ignore_index=True)
+                for p in self.PERIODS:
+                    merged = pd.concat([self.cubes[p], rollup(plus, p), rollup(minus, p, sign=-1)], ignore_index=True)
+                    merged = merged.groupby([p, *ROLLUP_DIMS], as_index=False)[["heures", "absences"]].sum()
+                    self.cubes[p] = merged[merged["absences"] > 0].reset_index(drop=True)
+            self.hashes = hashes
+            self.dims_hash = dims_hash
+            self.key = key
+
+    def cube(self, period: str) -> pd.DataFrame:
+        return self.cubes.get(period, pd.DataFrame(columns=[period, *ROLLUP_DIMS, "heures", "absences"]))
+
+
+# ================== Export الفرع (streaming) ==================
+# الجدول الكامل (غياب + متكوّن + مادة + حالة 10٪) يتبنى chunk بـchunk و يتكتب مباشرة في الملف
+# ⇒ الذاكرة محدودة بـchunk وحدة (زايد frame المصدر) مهما كان عدد السنين.
+EXPORT_CHUNK_ROWS = 20000
+EXPORT_FORMATS = {
+    "csv": "text/csv",
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    "parquet": "application/vnd.apache.parquet",
+}
+EXPORT_COLS = [
+    "annee", "date", "trainee_id", "nom", "telephone", "specialite", "subject_id", "matiere",
+    "heures_absence", "justifie", "commentaire", "total_non_justifie", "limit_10", "excess", "statut_10",
+]
+EXPORT_FLOAT_COLS = ["heures_absence", "total_non_justifie", "limit_10", "excess"]
+XLSX_MAX_ROWS = 1_048_575  # حدّ Excel (بلا الـheader) ⇒ ورقة جديدة
+
+
+def academic_year_labels(dates: pd.Series) -> pd.Series:
+    # نسخة vectorized من academic_year_of ("" كي التاريخ غالط)
+    start = (dates.dt.year - (dates.dt.month < ACADEMIC_YEAR_START_MONTH).astype(int)).astype("Int64")
+    return (start.astype(str) + "-" + (start + 1).astype(str)).where(start.notna(), "")
+
+
+def export_status(df_abs: pd.DataFrame, df_tr: pd.DataFrame, df_sub: pd.DataFrame, years: pd.Series) -> pd.DataFrame:
+    """
+    حالة 10٪ لكل (سنة، متكوّن، مادة): قاعدة 10٪ تتحسب سنة بسنة
+    """
+    cols = ["annee", "trainee_id", "subject_id", "total_non_justifie", "limit_10", "excess", "statut_10"]
+    parts = []
+    for year, part in df_abs.groupby(years.to_numpy(), sort=False):
+        grp = unjustified_totals(df_tr, df_sub, part)
+        if not grp.empty:
+            parts.append(grp[["trainee_id", "subject_id", "total_abs", "limit_10", "excess"]].assign(annee=year))
+    if not parts:
+        return pd.DataFrame(columns=cols)
+    out = pd.concat(parts, ignore_index=True).rename(columns={"total_abs": "total_non_justifie"})
+    out["statut_10"] = RISK_LABELS["ok"]
+    out.loc[out["excess"] > 0, "statut_10"] = RISK_LABELS["exceeded"]
+    for c in ["total_non_justifie", "limit_10", "excess"]:
+        out[c] = out[c].astype(float).round(2)
+    return out[cols]
+
+
+def export_chunks(sources, df_tr: pd.DataFrame, df_sub: pd.DataFrame, chunk_rows: int = EXPORT_CHUNK_ROWS):
+    """
+    sources: frames غيابات (الشيت الحالي ثم كل سنة أرشيف، ينجم يكون generator lazy)
+    ⇒ يولّد chunks بنفس الأعمدة (EXPORT_COLS) و نفس الـdtypes
+    """
+    tr = df_tr[["id", "nom", "telephone", "specialite"]].rename(columns={"id": "trainee_id"})
+    tr = tr.astype(str).drop_duplicates("trainee_id")
+    sub = df_sub[["id", "nom_matiere"]].rename(columns={"id": "subject_id", "nom_matiere": "matiere"})
+    sub = sub.astype(str).drop_duplicates("subject_id")
+    empty = True
+    for df_abs in sources:
+        if df_abs is None or df_abs.empty:
+            continue
+        dates = pd.to_datetime(df_abs["date"], errors="coerce", format="mixed")
+        years = academic_year_labels(dates)
+        status = export_status(df_abs, df_tr, df_sub, years)
+        for start in range(0, len(df_abs), chunk_rows):
+            part = df_abs.iloc[start : start + chunk_rows]
+            d = dates.iloc[start : start + chunk_rows]
+            part = pd.DataFrame({
+                "annee": years.iloc[start : start + chunk_rows].to_numpy(),
+                "date": d.dt.strftime("%Y-%m-%d").fillna(part["date"].astype(str)).to_numpy(),
+                "trainee_id": part["trainee_id"].astype(str).to_numpy(),
+                "subject_id": part["subject_id"].astype(str).to_numpy(),
+                "heures_absence": hours_col(part["heures_absence"]).to_numpy(),
+                "justifie": part["justifie"].astype(str).to_numpy(),
+                "commentaire": part["commentaire"].astype(str).to_numpy(),
+            })
+            out = (
+                part.merge(tr, on="trainee_id", how="left")
+                .merge(sub, on="subject_id", how="left")
+                .merge(status, on=["annee", "trainee_id", "subject_id"], how="left")
+            )
+            empty = False
+            yield export_frame(out)
+    if empty:
+        yield export_frame(pd.DataFrame(columns=EXPORT_COLS))
+
+
+def export_frame(df: pd.DataFrame) -> pd.DataFrame:
+    # dtypes ثابتة بين الـchunks (parquet يحتاج نفس الـschema)
+    df = df.reindex(columns=EXPORT_COLS)
+    for c in EXPORT_COLS:
+        if c in EXPORT_FLOAT_COLS:
+            df[c] = pd.to_numeric(df[c], errors="coerce").astype("float64")
+        else:
+            df[c] = df[c].fillna("").astype(str)
+    return df
+
+
+def write_export(chunks, path: str, fmt: str) -> int:
+    """
+    يكتب الـchunks في path بالصيغة (csv / xlsx / parquet) و يرجّع عدد السطور
+    """
+    n = 0
+    if fmt == "csv":
+        with open(path, "w", encoding="utf-8-sig", newline="") as f:
+            for i, chunk in enumerate(chunks):
+                chunk.to_csv(f, index=False, header=i == 0)
+                n += len(chunk)
+    elif fmt == "parquet":
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        writer = None
+        try:
+            for chunk in chunks:
+                table = pa.Table.from_pandas(chunk, preserve_index=False)
+                if writer is None:
+                    writer = pq.ParquetWriter(path, table.schema)
+                writer.write_table(table.cast(writer.schema))
+                n += len(chunk)
+        finally:
+            if writer is not None:
+                writer.close()
+    elif fmt == "xlsx":
+        from openpyxl import Workbook
+
+        wb = Workbook(write_only=True)  # السطور تتكتب للديسك بالتوالي، موش في الذاكرة
+        ws, in_sheet = None, 0
+        for chunk in chunks:
+            for row in chunk.itertuples(index=False, name=None):
+                if ws is None or in_sheet >= XLSX_MAX_ROWS:
+                    ws = wb.create_sheet(f"absences_{len(wb.worksheets) + 1}")
+                    ws.append(EXPORT_COLS)
+                    in_sheet = 0
+                ws.append([None if v != v else v for v in row])  # NaN ⇒ خانة فارغة
+                in_sheet += 1
+            n += len(chunk)
+        if ws is None:
+            wb.create_sheet("absences_1").append(EXPORT_COLS)
+        wb.save(path)
+    else:
+        raise ValueError(f"صيغة export غير معروفة: {fmt}")
+    return n
+
+
+# ================== Batch (بلا واجهة) ==================
+def read_sheet_df(sh, title: str, cols: list[str]) -> pd.DataFrame | None:
+    # None ⇒ الشيت ما يوجدش (موش كيف شيت فارغ)
+    import gspread
+
+    try:
+        return values_to_df(sh.worksheet(title).get_all_values(), cols)
+    except gspread.WorksheetNotFound:
+        return None
+
+
+def read_branch_df(sh, base: str, code: str, branch: str, cols: list[str], legacy_ids=None) -> pd.DataFrame:
+    """
+    شيت الفرع (Trainees_MB...)، و إذا مازال ما تخلقش (الواجهة تخلقو أول مرة يتحل الفرع)
+    نرجعو للشيت القديم المشترك مفلتر بالفرع، كيف legacy_branch_rows في الواجهة.
+    """
+    df = read_sheet_df(sh, sheet_title(base, code), cols)
+    if df is not None:
+        return df
+    df = read_sheet_df(sh, base, cols)
+    if df is None:
+        raise LookupError(f"الشيت {sheet_title(base, code)} ما يوجدش، و حتى الشيت القديم {base}")
+    if "branche" in df.columns:
+        df = df[df["branche"] == branch]
+    elif "trainee_id" in df.columns and legacy_ids is not None:
+        df = df[df["trainee_id"].isin(legacy_ids())]
+    else:
+        df = df.iloc[0:0]
+    log.warning("%s ما يوجدش ⇒ نقراو من %s (%d سطر للفرع %s)", sheet_title(base, code), base, len(df), branch)
+    return df.reset_index(drop=True)
+
+
+def load_branch_frames(sh, code: str, branch: str) -> dict[str, pd.DataFrame]:
+    def legacy_ids() -> set[str]:
+        # Absences القديمة ما فيهاش branche ⇒ نعتمدو على متكوّني الفرع في Trainees القديمة
+        tr = read_sheet_df(sh, TRAINEES_SHEET, TRAINEES_COLS)
+        if tr is None or "branche" not in tr.columns:
+            return set()
+        return set(tr.loc[tr["branche"] == branch, "id"])
+
+    return {
+        "trainees": read_branch_df(sh, TRAINEES_SHEET, code, branch, TRAINEES_COLS),
+        "subjects": read_branch_df(sh, SUBJECTS_SHEET, code, branch, SUBJECTS_COLS),
+        "absences": read_branch_df(sh, ABSENCES_SHEET, code, branch, ABSENCES_COLS, legacy_ids),
+    }
+
+
+def branch_reports(
+    frames: dict[str, pd.DataFrame],
+    branch_name: str,
+    d_from: date,
+    d_to: date,
+    period_label: str,
+    remedial_month: str,
+) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    (تجاوزات 10٪، تقارير الفترة) لفرع كامل أو لجزء منو (تخصّص) مع روابط wa.me جاهزة
+    """
+    df_tr, df_sub = frames["trainees"], frames["subjects"]
+    df_abs = in_current_year(frames["absences"], "date")
+
+    exceeded = exceedances(unjustified_totals(df_tr, df_sub, df_abs))
+    exceeded.insert(0, "branche", branch_name)
+    msgs = [exceedance_message(r, remedial_month) for _, r in exceeded.iterrows()]
+    exceeded["wa_trainee"] = [wa_link(t, m) for t, m in zip(exceeded["tel"], msgs)]
+    exceeded["wa_parent"] = [wa_link(t, m) for t, m in zip(exceeded["tel_parent"], msgs)]
+
+    reports = []
+    with_abs = set(frames["absences"]["trainee_id"])
+    for _, tr_row in df_tr[df_tr["id"].isin(with_abs)].iterrows():
+        msg, _ = build_whatsapp_message_for_trainee(
+            tr_row, frames["absences"], df_sub, branch_name, d_from, d_to, period_label
+        )
+        if not msg:
+            continue
+        reports.append({
+            "branche": branch_name,
+            "trainee_id": tr_row["id"],
+            "nom": tr_row["nom"],
+            "specialite": tr_row["specialite"],
+            "period_label": period_label,
+            "message": msg,
+            "wa_trainee": wa_link(tr_row["telephone"], msg),
+            "wa_parent": wa_link(tr_row["tel_parent"], msg),
+        })
+    return exceeded, pd.DataFrame(
+        reports,
+        columns=["branche", "trainee_id", "nom", "specialite", "period_label", "message", "wa_trainee", "wa_parent"],
+    )
+
+
+def split_by_specialty(frames: dict[str, pd.DataFrame]) -> dict[str, dict[str, pd.DataFrame]]:
+    # نقسمو الفرع حسب التخصّص باش نجمو نحسبو بالتوازي (المواد صغار ⇒ نعطيوهم كاملين)
+    out = {}
+    df_tr = frames["trainees"]
+    for spec, df_tr_s in df_tr.groupby(df_tr["specialite"].fillna("")):
+        out[spec] = {
+            "trainees": df_tr_s,
+            "subjects": frames["subjects"],
+            "absences": frames["absences"][frames["absences"]["trainee_id"].isin(df_tr_s["id"])],
+        }
+    return out
+
+
+# ================== Instrumentation (Sheets API + توقيت) ==================
+class Metrics:
+    """
+    عدّاد و توقيت لكل call متاع Google Sheets (حسب op و sheet) و لكل section/loader.
+    thread-safe، ويحفظ آخر الأحداث كـlogs مهيكلة (JSON lines).
+    """
+
+    def __init__(self, max_events: int = 5000):
+        self.lock = threading.Lock()
+        self.api = {}        # (op, sheet) -> [count, total_s, max_s, errors]
+        self.sections = {}   # name -> [count, total_s, max_s, errors]
+        self.events = collections.deque(maxlen=max_events)
+
+    def _record(self, table: dict, key, kind: str, seconds: float, ok: bool, session: str | None, **fields):
+        with self.lock:
+            row = table.setdefault(key, [0, 0.0, 0.0, 0])
+            row[0] += 1
+            row[1] += seconds
+            row[2] = max(row[2], seconds)
+            row[3] += 0 if ok else 1
+            event = {
+                "ts": datetime.utcnow().isoformat(),
+                "kind": kind,
+                "ms": round(seconds * 1000, 2),
+                "ok": ok,
+                "session": session,
+                **fields,
+            }
+            self.events.append(event)
+        log.debug(json.dumps(event, ensure_ascii=False))
+
+    @contextmanager
+    def api_call(self, op: str, sheet: str, session: str | None = None):
+        t0, ok = time.perf_counter(), False
+        try:
+            yield
+            ok = True
+        finally:
+            self._record(self.api, (op, sheet), "api", time.perf_counter() - t0, ok, session, op=op, sheet=sheet)
+
+    @contextmanager
+    def section(self, name: str, session: str | None = None):
+        t0, ok = time.perf_counter(), False
+        try:
+            yield
+            ok = True
+        finally:
+            self._record(self.sections, name, "section", time.perf_counter() - t0, ok, session, name=name)
+
+    def api_table(self) -> pd.DataFrame:
+        with self.lock:
+            rows = [(op, sheet, *v) for (op, sheet), v in self.api.items()]
+        df = pd.DataFrame(rows, columns=["op", "sheet", "calls", "total_s", "max_s", "errors"])
+        df["avg_ms"] = (df["total_s"] / df["calls"].clip(lower=1) * 1000).round(1)
+        return df.sort_values("calls", ascending=False).reset_index(drop=True)
+
+    def section_table(self) -> pd.DataFrame:
+        with self.lock:
+            rows = [(name, *v) for name, v in self.sections.items()]
+        df = pd.DataFrame(rows, columns=["section", "runs", "total_s", "max_s", "errors"])
+        df["avg_ms"] = (df["total_s"] / df["runs"].clip(lower=1) * 1000).round(1)
+        return df.sort_values("total_s", ascending=False).reset_index(drop=True)
+
+    def session_calls(self, session: str) -> int:
+        with self.lock:
+            return sum(1 for e in self.events if e["kind"] == "api" and e["session"] == session)
+
+    def export_jsonl(self) -> str:
+        with self.lock:
+            return "\n".join(json.dumps(e, ensure_ascii=False) for e in self.events)
+
+    def reset(self):
+        with self.lock:
+            self.api.clear()
+            self.sections.clear()
+            self.events.clear()
+
+
+class Instrumented:
+    """
+    proxy حول Client/Spreadsheet/Worksheet متاع gspread: كل method call يتحسب في Metrics.
+    الـspreadsheets و الـworksheets اللي يرجّعهم يتغلّفو زادة.
+    """
+
+    def __init__(self, obj, metrics: Metrics, sheet: str = "*", session=None):
+        self._obj = obj
+        self._metrics = metrics
+        self._sheet = sheet
+        self._session = session
+
+    def __getattr__(self, name):
+        attr = getattr(self._obj, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            session = self._session() if callable(self._session) else self._session
+            sheet = self._sheet
+            if name in ("worksheet", "add_worksheet"):
+                sheet = str(kwargs.get("title", args[0] if args else sheet))
+            with self._metrics.api_call(name, sheet, session):
+                res = attr(*args, **kwargs)
+            if hasattr(res, "get_all_values"):
+                return Instrumented(res, self._metrics, res.title, self._session)
+            if hasattr(res, "worksheet"):
+                return Instrumented(res, self._metrics, "*", self._session)
+            return res
+
+        return call
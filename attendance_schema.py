@@ -0,0 +1,43 @@
+# attendance_schema.py
+# الفروع، أسماء الشيتات و الأعمدة — بلا حتى dependency (لا pandas لا gspread)
+# باش شاشة الدخول في AttendanceHub.py تنجم تتعرض قبل ما نحمّلو المكتبات الثقال.
+
+
+# ================== الشيتات و الأعمدة ==================
+# الفروع: اسم الفرع ⇒ كود قصير (يستعمل في أسماء الشيتات و branch_passwords)
+DEFAULT_BRANCHES = {"Menzel Bourguiba": "MB", "Bizerte": "BZ"}
+
+# أسماء الشيتات (كل فرع عندو نسخة منفصلة: Trainees_MB, Absences_BZ, ...)
+TRAINEES_SHEET = "Trainees"
+SUBJECTS_SHEET = "Subjects"
+ABSENCES_SHEET = "Absences"
+NOTIF_LOG_SHEET = "Notifications_Log"
+
+TRAINEES_COLS = ["id", "nom", "telephone", "tel_parent", "branche", "specialite", "date_debut", "actif"]
+
+SUBJECTS_COLS = [
+    "id",
+    "nom_matiere",
+    "branche",
+    "specialites",  # قائمة تخصّصات مفصولة بفاصلة
+    "heures_totales",
+    "heures_semaine",
+]
+
+ABSENCES_COLS = ["id", "trainee_id", "subject_id", "date", "heures_absence", "justifie", "commentaire"]
+
+NOTIF_LOG_COLS = [
+    "id",
+    "trainee_id",
+    "phone",
+    "target",       # Trainee / Parent
+    "branche",
+    "period_from",
+    "period_to",
+    "period_label",
+    "sent_at_iso",  # تاريخ ووقت الإرسال (UTC ISO)
+]
+
+
+def sheet_title(base: str, code: str) -> str:
+    return f"{base}_{code}"
@@ -0,0 +1,121 @@
+# bench_startup.py
+# قياس الـstartup متاع AttendanceHub.py (AppTest + backend محلي، بلا Google):
+#   - شاشة الدخول: أول run في process جديد + rerun (لازم بلا pandas/gspread و بلا Sheets calls)
+#   - أول run بعد الدخول للفرع (كل التبويبات) + rerun عادي
+# كل تكرار يخدم في process جديد (cold) و النتيجة median.
+#
+# مثال:
+#   python bench_startup.py --repeat 5 --absences 20000
+#   python bench_startup.py --app /tmp/AttendanceHub_old.py   # مقارنة مع نسخة أخرى
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+APP = os.path.join(os.path.dirname(os.path.abspath(__file__)), "AttendanceHub.py")
+HEAVY_MODULES = ["pandas", "gspread", "google.oauth2.service_account", "attendance_engine"]
+BRANCH = ("Bizerte", "BZ")
+
+
+def ms(fn) -> float:
+    t0 = time.perf_counter()
+    fn()
+    return (time.perf_counter() - t0) * 1000
+
+
+def sheets_calls() -> int:
+    # local_sheets ما يتحمّلش قبل ما التطبيق يحتاج الـbackend ⇒ 0 calls
+    mod = sys.modules.get("local_sheets")
+    return mod.local_spreadsheet().calls if mod else 0
+
+
+def child(args) -> dict:
+    os.environ["ATTENDANCEHUB_BACKEND"] = "local"
+    from streamlit.testing.v1 import AppTest
+
+    at = AppTest.from_file(args.app, default_timeout=args.timeout)
+    from attendance_schema import DEFAULT_BRANCHES
+
+    at.secrets["branch_passwords"] = {code: "pw" for code in DEFAULT_BRANCHES.values()}
+    out = {"login_first_ms": ms(at.run)}
+    out["login_heavy_modules"] = [m for m in HEAVY_MODULES if m in sys.modules]
+    out["login_sheets_calls"] = sheets_calls()
+    out["login_rerun_ms"] = ms(at.run)
+
+    # الداتا تتعبّى بعد قياس شاشة الدخول (loadtest يحمّل pandas)
+    import random
+
+    from local_sheets import local_spreadsheet
+    from loadtest import seed_branch
+
+    sh = local_spreadsheet()
+    seed_branch(sh, BRANCH[1], BRANCH[0], args.trainees, args.subjects, args.absences, random.Random(0))
+    calls0 = sh.calls
+
+    def enter():
+        at.sidebar.selectbox[0].select(BRANCH[0]).run()
+        at.sidebar.text_input[0].input("pw")
+        at.sidebar.button[0].click().run()
+        at.run()
+
+    out["branch_first_ms"] = ms(enter)
+    out["branch_sheets_calls"] = sh.calls - calls0
+    out["errors"] = [str(e.value)[:200] for e in at.exception]
+    calls0 = sh.calls
+    out["rerun_ms"] = ms(at.run)
+    out["rerun_sheets_calls"] = sh.calls - calls0
+    return out
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="AttendanceHub startup benchmark (AppTest + Sheets محلي)")
+    parser.add_argument("--app", default=APP, help="السكريبت اللي نقيسوه")
+    parser.add_argument("--repeat", type=int, default=3, help="عدد الـprocesses (cold)")
+    parser.add_argument("--trainees", type=int, default=300)
+    parser.add_argument("--subjects", type=int, default=20)
+    parser.add_argument("--absences", type=int, default=10000)
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--out", default="", help="ملف النتيجة (افتراضيًا بلا ملف، النتيجة في الـstdout)")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        print(json.dumps(child(args)))
+        return 0
+
+    cmd = [sys.executable, os.path.abspath(__file__), "--child", "--app", args.app,
+           "--trainees", str(args.trainees), "--subjects", str(args.subjects),
+           "--absences", str(args.absences), "--timeout", str(args.timeout)]
+    runs = []
+    for i in range(args.repeat):
+        res = subprocess.run(cmd, capture_output=True, text=True)
+        if res.returncode != 0:
+            print(res.stderr[-2000:], file=sys.stderr)
+            return 1
+        runs.append(json.loads(res.stdout.strip().splitlines()[-1]))
+
+    lines = [f"AttendanceHub startup — {os.path.basename(args.app)}, {args.repeat} cold runs, "
+             f"{args.trainees} متكوّن / {args.absences} غياب (median)"]
+    for key in ["login_first_ms", "login_rerun_ms", "login_sheets_calls",
+                "branch_first_ms", "branch_sheets_calls", "rerun_ms", "rerun_sheets_calls"]:
+        lines.append(f"  {key:<22} {statistics.median(r[key] for r in runs):>10.1f}")
+    heavy = sorted({m for r in runs for m in r["login_heavy_modules"]})
+    lines.append(f"  login_heavy_modules    {', '.join(heavy) or '—'}")
+    errors = [e for r in runs for e in r["errors"]]
+    for e in errors[:5]:
+        lines.append(f"  ❌ {e}")
+
+    text = "\n".join(lines)
+    print(text)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,257 @@
+# loadtest.py
+# load test: برشا جلسات (staff) في نفس الوقت على AttendanceHub.py الحقيقي عبر AppTest،
+# مع backend محلي (local_sheets) عوض Google ⇒ نعرفو قدّاش من مستعمل يهزّ الـquota متاع Sheets
+# و قدّاش يثقلو الـreruns كي الجلسات يخدمو مع بعضهم.
+#
+# مثال:
+#   python loadtest.py --sessions 20 --iterations 5 --absences 20000 --latency-ms 80
+#
+# كل جلسة: تدخل لفرع، و بعدها كل iteration: rerun (كل التبويبات، منهم تبويب 4)، زيادة غياب،
+# تبديل الفرع، و import دفعة غيابات.
+# كل جلسة في process وحدها (AppTest متاعها، بلا patches على Streamlit) و الـbackend واحد
+# مشترك (serve_local_sheets) ⇒ الـruns و الـlatency متاع Sheets يتعدّاو بالتوازي. الكاشات
+# (cache_resource) موش مشتركة بين الجلسات: كل process كيف سرفر وحدو ⇒ الأرقام pessimistic.
+# ملاحظة: AppTest ما يسوقش st.file_uploader ⇒ الـimport يتعمل بنفس دوال attendance_engine
+# (validate_absence_chunk + append_rows) مباشرة على الـbackend المحلي.
+
+import argparse
+import multiprocessing
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, timedelta
+
+import pandas as pd
+
+from attendance_engine import (
+    ABSENCES_COLS,
+    ABSENCES_SHEET,
+    DEFAULT_BRANCHES,
+    NOTIF_LOG_COLS,
+    NOTIF_LOG_SHEET,
+    SUBJECTS_COLS,
+    SUBJECTS_SHEET,
+    TRAINEES_COLS,
+    TRAINEES_SHEET,
+    sheet_title,
+    validate_absence_chunk,
+)
+
+APP = os.path.join(os.path.dirname(os.path.abspath(__file__)), "AttendanceHub.py")
+SPECIALTIES = ["Anglais A2", "Français B1", "Informatique", "Comptabilité"]
+
+
+# ================== Seed ==================
+def seed_branch(sh, code: str, branch_name: str, n_trainees: int, n_subjects: int, n_absences: int, rng):
+    trainees = [
+        [uuid.uuid4().hex[:10], f"Trainee {code}-{i}", f"216{20000000 + i}", "", branch_name,
+         SPECIALTIES[i % len(SPECIALTIES)], "2026-09-15", "1"]
+        for i in range(n_trainees)
+    ]
+    subjects = [
+        [uuid.uuid4().hex[:10], f"Matière {i}", branch_name, SPECIALTIES[i % len(SPECIALTIES)], "60", "3"]
+        for i in range(n_subjects)
+    ]
+    start = date(2026, 9, 15)
+    absences = []
+    for _ in range(n_absences):
+        tr = rng.choice(trainees)
+        subs = [s for s in subjects if s[3] == tr[5]] or subjects
+        absences.append([
+            uuid.uuid4().hex[:10], tr[0], rng.choice(subs)[0],
+            (start + timedelta(days=rng.randrange(120))).isoformat(),
+            str(rng.choice([1, 1.5, 2, 3])), rng.choice(["Oui", "Non", "Non"]), "",
+        ])
+    sh.load(sheet_title(TRAINEES_SHEET, code), [TRAINEES_COLS] + trainees)
+    sh.load(sheet_title(SUBJECTS_SHEET, code), [SUBJECTS_COLS] + subjects)
+    sh.load(sheet_title(ABSENCES_SHEET, code), [ABSENCES_COLS] + absences)
+    sh.load(sheet_title(NOTIF_LOG_SHEET, code), [NOTIF_LOG_COLS])
+    return [t[0] for t in trainees], [s[0] for s in subjects]
+
+
+# ================== Sessions ==================
+class Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.rows = []
+
+    def timed(self, session: int, op: str, fn):
+        t0 = time.perf_counter()
+        err = ""
+        try:
+            res = fn()
+            exc = getattr(res, "exception", None)
+            if exc:
+                err = str(exc[0].value)[:200]
+        except Exception as e:
+            err = f"{type(e).__name__}: {e}"[:200]
+        with self.lock:
+            self.rows.append({"session": session, "op": op, "ms": (time.perf_counter() - t0) * 1000, "error": err})
+
+    def table(self) -> pd.DataFrame:
+        df = pd.DataFrame(self.rows)
+        if df.empty:
+            return df
+        out = df.groupby("op")["ms"].describe(percentiles=[0.5, 0.9, 0.99])
+        out["errors"] = df.groupby("op")["error"].apply(lambda e: int((e != "").sum()))
+        return out[["count", "50%", "90%", "99%", "max", "errors"]].round(1)
+
+
+def new_app(timeout: float, branches: dict):
+    from streamlit.testing.v1 import AppTest
+
+    at = AppTest.from_file(APP, default_timeout=timeout)
+    at.secrets["branch_passwords"] = {code: f"pw-{code}" for code in branches.values()}
+    return at
+
+
+def login(at, branch_name: str, password: str):
+    at.sidebar.selectbox[0].select(branch_name).run()
+    if at.sidebar.text_input:
+        # دخول الفرع يعمل st.stop() في نفس الـrun ⇒ التبويبات يظهرو في الـrun اللي بعدو
+        at.sidebar.text_input[0].input(password)
+        at.sidebar.button[0].click().run()
+    return at.run()
+
+
+def add_absence(at, rng):
+    day = date(2026, 9, 15) + timedelta(days=rng.randrange(120))
+    for d in at.date_input:
+        if d.label == "تاريخ الغياب":
+            d.set_value(day)
+    for n in at.number_input:
+        if n.label == "عدد ساعات الغياب":
+            n.set_value(float(rng.choice([1, 2, 3])))
+    for b in at.button:
+        if b.label == "📥 حفظ الغياب":
+            b.click()
+            break
+    return at.run()
+
+
+def import_batch(sh, code: str, trainee_ids: list, subject_ids: list, rows: int, rng):
+    chunk = pd.DataFrame({
+        "trainee_id": [rng.choice(trainee_ids) for _ in range(rows)],
+        "subject_id": [rng.choice(subject_ids) for _ in range(rows)],
+        "date": [(date(2026, 9, 15) + timedelta(days=rng.randrange(120))).isoformat() for _ in range(rows)],
+        "heures_absence": [str(rng.choice([1, 2])) for _ in range(rows)],
+        "justifie": "Non",
+        "commentaire": "loadtest",
+    })
+    ok, _ = validate_absence_chunk(chunk, set(trainee_ids), set(subject_ids), 2)
+    ws = sh.worksheet(sheet_title(ABSENCES_SHEET, code))
+    ws.append_rows(ok[ABSENCES_COLS].values.tolist())
+
+
+def run_session(i: int, args, branches: dict, seeds: dict, sh, rec: Recorder):
+    rng = random.Random(args.seed + i)
+    names = list(branches)
+    passwords = {code: f"pw-{code}" for code in branches.values()}
+    time.sleep(rng.random() * args.ramp_up)
+
+    at = new_app(args.timeout, branches)
+    rec.timed(i, "startup", at.run)
+    current = names[i % len(names)]
+    rec.timed(i, "login", lambda: login(at, current, passwords[branches[current]]))
+
+    for _ in range(args.iterations):
+        rec.timed(i, "rerun (all tabs)", at.run)
+        rec.timed(i, "add_absence", lambda: add_absence(at, rng))
+        if len(names) > 1:
+            current = rng.choice([n for n in names if n != current])
+            rec.timed(i, "switch_branch", lambda: login(at, current, passwords[branches[current]]))
+        if args.import_rows:
+            code = branches[current]
+            rec.timed(i, "import", lambda: import_batch(sh, code, *seeds[code], args.import_rows, rng))
+        time.sleep(args.think_time)
+
+
+def session_process(i: int, args, branches: dict, seeds: dict, address: str) -> tuple[list, float]:
+    # يخدم في process جديد (spawn): الـbackend هو متاع الـprocess الرئيسي
+    os.environ["ATTENDANCEHUB_BACKEND"] = "local"
+    os.environ["LOCAL_SHEETS_ADDRESS"] = address
+    from local_sheets import local_spreadsheet
+
+    rec = Recorder()
+    run_session(i, args, branches, seeds, local_spreadsheet(), rec)
+    return rec.rows, max_rss_mb()
+
+
+def max_rss_mb() -> float:
+    try:
+        import resource
+    except ImportError:  # Windows
+        return float("nan")
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024 / (1024 if sys.platform == "darwin" else 1)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="AttendanceHub load test (AppTest + Sheets محلي)")
+    parser.add_argument("--sessions", type=int, default=10, help="عدد الجلسات المتوازية")
+    parser.add_argument("--iterations", type=int, default=3, help="عدد الدورات لكل جلسة")
+    parser.add_argument("--trainees", type=int, default=300, help="متكوّنين لكل فرع")
+    parser.add_argument("--subjects", type=int, default=20, help="مواد لكل فرع")
+    parser.add_argument("--absences", type=int, default=10000, help="غيابات لكل فرع")
+    parser.add_argument("--import-rows", type=int, default=200, help="سطور كل import (0 ⇒ بلا import)")
+    parser.add_argument("--latency-ms", type=float, default=0, help="تأخير مصطنع لكل Sheets call")
+    parser.add_argument("--think-time", type=float, default=0.5, help="ثواني بين الدورات")
+    parser.add_argument("--ramp-up", type=float, default=2.0, help="الجلسات تبدا موزّعة على الثواني هذي")
+    parser.add_argument("--timeout", type=float, default=120, help="timeout لكل rerun")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", help="CSV فيه كل القياسات")
+    args = parser.parse_args(argv)
+
+    os.environ.pop("LOCAL_SHEETS_ADDRESS", None)
+    os.environ["LOCAL_SHEETS_LATENCY_MS"] = str(args.latency_ms)
+    from local_sheets import local_spreadsheet, serve_local_sheets
+
+    sh = local_spreadsheet()
+    rng = random.Random(args.seed)
+    branches = dict(DEFAULT_BRANCHES)
+    seeds = {
+        code: seed_branch(sh, code, name, args.trainees, args.subjects, args.absences, rng)
+        for name, code in branches.items()
+    }
+    print(f"🌱 {len(branches)} فروع × {args.trainees} متكوّن، {args.absences} غياب — {args.sessions} جلسة")
+
+    address = serve_local_sheets(sh)
+    rec = Recorder()
+    session_rss = []
+    calls0, t0 = sh.calls, time.time()
+    ctx = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=args.sessions, mp_context=ctx) as pool:
+        futures = [pool.submit(session_process, i, args, branches, seeds, address) for i in range(args.sessions)]
+        for f in futures:
+            rows, rss = f.result()
+            rec.rows.extend(rows)
+            session_rss.append(rss)
+    elapsed = time.time() - t0
+    calls = sh.calls - calls0
+
+    pd.set_option("display.width", 140)
+    print("\n⏱️ latency (ms)")
+    print(rec.table().to_string())
+    print(f"\n📡 Sheets API calls: {calls} في {elapsed:.1f}s ⇒ {calls / elapsed * 60:.0f}/دقيقة "
+          f"(quota Google: 300 قراية/دقيقة للمشروع، 60 لكل مستعمل)")
+    by_op = pd.Series(sh.by_op, dtype="int64").sort_values(ascending=False)
+    by_op.index = [f"{op} {sheet}" for op, sheet in by_op.index]
+    print(by_op.head(15).to_string())
+    print(f"🧠 max RSS لكل جلسة (process): median {pd.Series(session_rss).median():.0f} MB، "
+          f"max {max(session_rss):.0f} MB — backend: {max_rss_mb():.0f} MB")
+
+    errors = [r for r in rec.rows if r["error"]]
+    for r in errors[:10]:
+        print(f"❌ session {r['session']} {r['op']}: {r['error']}")
+    if args.out:
+        pd.DataFrame(rec.rows).to_csv(args.out, index=False)
+        print(f"💾 {args.out}")
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,295 @@
+# local_sheets.py
+# Google Sheets محلي في الذاكرة (نفس methods متاع gspread اللي يستعملهم AttendanceHub)
+# للتجارب و الـload test بلا انترنت و بلا quota:
+#
+#   ATTENDANCEHUB_BACKEND=local streamlit run AttendanceHub.py
+#
+# LOCAL_SHEETS_LATENCY_MS=80 ⇒ كل call تستنّى 80ms (باش نقربو من Google الحقيقي).
+# LOCAL_SHEETS_ADDRESS=127.0.0.1:PORT ⇒ نفس الـspreadsheet مشترك بين برشا processes
+# (serve_local_sheets في process واحد، و البقية يحكيو معاه) — loadtest.py يستعملها.
+
+import collections
+import os
+import re
+import threading
+import time
+from multiprocessing.connection import Client, Listener
+
+from gspread.exceptions import WorksheetNotFound
+from gspread.utils import a1_to_rowcol
+
+LOCAL_SHEET_ID = "local"
+LOCAL_SHEETS_AUTHKEY = b"attendancehub-local-sheets"
+
+
+class LocalWorksheet:
+    def __init__(self, spreadsheet, title: str):
+        self.spreadsheet = spreadsheet
+        self.title = title
+        self.id = abs(hash(title)) % 10**9
+        self._rows: list[list[str]] = []
+
+    def _wait(self, op: str):
+        self.spreadsheet.count(op, self.title)
+        if self.spreadsheet.latency:
+            time.sleep(self.spreadsheet.latency)
+
+    def _values(self) -> list[list[str]]:
+        rows = [list(r) for r in self._rows]
+        while rows and not any(rows[-1]):
+            rows.pop()
+        width = max((len(r) for r in rows), default=0)
+        return [r + [""] * (width - len(r)) for r in rows]
+
+    def _set(self, row: int, col: int, value):
+        while len(self._rows) < row:
+            self._rows.append([])
+        cur = self._rows[row - 1]
+        while len(cur) < col:
+            cur.append("")
+        cur[col - 1] = "" if value is None else str(value)
+
+    def _write(self, range_name: str, values):
+        m = re.match(r"^(\d+):\d+$", range_name)
+        if m:
+            row, col = int(m.group(1)), 1
+        else:
+            row, col = a1_to_rowcol(range_name.split(":")[0])
+        for i, r in enumerate(values):
+            for j, v in enumerate(r):
+                self._set(row + i, col + j, v)
+
+    # ---- قراية ----
+    def get_all_values(self, **kwargs):
+        self._wait("get_all_values")
+        with self.spreadsheet.lock:
+            return self._values()
+
+    def row_values(self, row: int, **kwargs):
+        self._wait("row_values")
+        with self.spreadsheet.lock:
+            vals = self._values()
+            return list(vals[row - 1]) if len(vals) >= row else []
+
+    def col_values(self, col: int, **kwargs):
+        self._wait("col_values")
+        with self.spreadsheet.lock:
+            out = [r[col - 1] if len(r) >= col else "" for r in self._values()]
+        while out and out[-1] == "":
+            out.pop()
+        return out
+
+    def batch_get(self, ranges, **kwargs):
+        self._wait("batch_get")
+        out = []
+        with self.spreadsheet.lock:
+            vals = self._values()
+            for rng in ranges:
+                row, col = a1_to_rowcol(rng.split(":")[0])
+                v = vals[row - 1][col - 1] if len(vals) >= row and len(vals[row - 1]) >= col else ""
+                out.append([[v]] if v else [])
+        return out
+
+    # ---- كتابة ----
+    def update(self, range_name=None, values=None, **kwargs):
+        if isinstance(range_name, list):  # صيغة gspread 6: update(values, range_name)
+            range_name, values = values, range_name
+        self._wait("update")
+        with self.spreadsheet.lock:
+            self._write(range_name, values)
+
+    def update_cell(self, row: int, col: int, value):
+        self._wait("update_cell")
+        with self.spreadsheet.lock:
+            self._set(row, col, value)
+
+    def batch_update(self, data, **kwargs):
+        self._wait("batch_update")
+        with self.spreadsheet.lock:
+            for d in data:
+                self._write(d["range"], d["values"])
+
+    def append_row(self, values, **kwargs):
+        self.append_rows([values], **kwargs)
+
+    def append_rows(self, values, **kwargs):
+        self._wait("append_rows")
+        with self.spreadsheet.lock:
+            n = len(self._values())
+            self._rows = self._rows[:n] + [["" if v is None else str(v) for v in r] for r in values]
+
+    def delete_rows(self, start_index: int, end_index: int | None = None):
+        self._wait("delete_rows")
+        with self.spreadsheet.lock:
+            del self._rows[start_index - 1 : (end_index or start_index)]
+
+    def clear(self):
+        self._wait("clear")
+        with self.spreadsheet.lock:
+            self._rows = []
+
+    def resize(self, rows=None, cols=None):
+        self._wait("resize")
+
+
+class LocalSpreadsheet:
+    def __init__(self, key: str, latency: float = 0.0):
+        self.id = key
+        self.lock = threading.RLock()
+        self.latency = latency
+        self.calls = 0
+        self.by_op = collections.Counter()  # (op, sheet) -> عدد
+        self._sheets: dict[str, LocalWorksheet] = {}
+
+    def count(self, op: str, sheet: str = "*"):
+        with self.lock:
+            self.calls += 1
+            self.by_op[(op, sheet)] += 1
+
+    def worksheet(self, title: str) -> LocalWorksheet:
+        self.count("worksheet", title)
+        with self.lock:
+            if title not in self._sheets:
+                raise WorksheetNotFound(title)
+            return self._sheets[title]
+
+    def worksheets(self) -> list[LocalWorksheet]:
+        self.count("worksheets")
+        with self.lock:
+            return list(self._sheets.values())
+
+    def add_worksheet(self, title: str, rows=None, cols=None, **kwargs) -> LocalWorksheet:
+        self.count("add_worksheet", title)
+        with self.lock:
+            ws = self._sheets.setdefault(title, LocalWorksheet(self, title))
+            return ws
+
+    def del_worksheet(self, ws: LocalWorksheet):
+        self.count("del_worksheet", ws.title)
+        with self.lock:
+            self._sheets.pop(ws.title, None)
+
+    def load(self, title: str, rows: list[list[str]]):
+        # تعبئة مباشرة (seed) بلا ما تتحسب calls
+        with self.lock:
+            ws = self._sheets.setdefault(title, LocalWorksheet(self, title))
+            ws._rows = [[str(v) for v in r] for r in rows]
+
+
+# ================== مشاركة بين processes ==================
+# الـworksheets يتبعثو بالـtitle، و الـcalls (op، args) تتعدّى للـLocalSpreadsheet الحقيقي.
+# thread لكل connection ⇒ الـlatency متاع processes مختلفين تتعدّى في نفس الوقت.
+def serve_local_sheets(spreadsheet: LocalSpreadsheet, address=("127.0.0.1", 0)) -> str:
+    """
+    يبدا server في الخلفية و يرجّع العنوان "host:port" (لـLOCAL_SHEETS_ADDRESS)
+    """
+    listener = Listener(address, authkey=LOCAL_SHEETS_AUTHKEY)
+
+    def sheet(title: str) -> LocalWorksheet:
+        # بلا count: الـcall الحقيقية (op) هي اللي تتحسب
+        with spreadsheet.lock:
+            if title not in spreadsheet._sheets:
+                raise WorksheetNotFound(title)
+            return spreadsheet._sheets[title]
+
+    def call(title, op, args, kwargs):
+        if op.startswith("_"):
+            raise AttributeError(op)
+        if title is not None:
+            return getattr(sheet(title), op)(*args, **kwargs)
+        if op == "worksheets":
+            return [ws.title for ws in spreadsheet.worksheets()]
+        if op == "del_worksheet":
+            return spreadsheet.del_worksheet(sheet(args[0]))
+        res = getattr(spreadsheet, op)(*args, **kwargs)
+        return res.title if isinstance(res, LocalWorksheet) else res
+
+    def handle(conn):
+        with conn:
+            while True:
+                try:
+                    title, op, args, kwargs = conn.recv()
+                except (EOFError, OSError):
+                    return
+                try:
+                    conn.send((True, call(title, op, args, kwargs)))
+                except Exception as e:
+                    conn.send((False, e))
+
+    def accept():
+        while True:
+            conn = listener.accept()
+            threading.Thread(target=handle, args=(conn,), daemon=True).start()
+
+    threading.Thread(target=accept, name="local-sheets-server", daemon=True).start()
+    host, port = listener.address
+    return f"{host}:{port}"
+
+
+class RemoteWorksheet:
+    def __init__(self, spreadsheet, title: str):
+        self.spreadsheet = spreadsheet
+        self.title = title
+        self.id = abs(hash(title)) % 10**9
+
+    def __getattr__(self, op: str):
+        if op.startswith("_"):
+            raise AttributeError(op)
+        return lambda *args, **kwargs: self.spreadsheet._call(self.title, op, args, kwargs)
+
+
+class RemoteSpreadsheet:
+    """
+    نفس واجهة LocalSpreadsheet، لكن الداتا في process آخر (serve_local_sheets)
+    """
+
+    def __init__(self, key: str, address: str):
+        host, port = address.rsplit(":", 1)
+        self.id = key
+        self._conn = Client((host, int(port)), authkey=LOCAL_SHEETS_AUTHKEY)
+        self._lock = threading.Lock()
+
+    def _call(self, title, op: str, args=(), kwargs=None):
+        with self._lock:
+            self._conn.send((title, op, args, kwargs or {}))
+            ok, res = self._conn.recv()
+        if not ok:
+            raise res
+        return res
+
+    def worksheet(self, title: str) -> RemoteWorksheet:
+        return RemoteWorksheet(self, self._call(None, "worksheet", (title,)))
+
+    def worksheets(self) -> list[RemoteWorksheet]:
+        return [RemoteWorksheet(self, t) for t in self._call(None, "worksheets")]
+
+    def add_worksheet(self, title: str, rows=None, cols=None, **kwargs) -> RemoteWorksheet:
+        return RemoteWorksheet(self, self._call(None, "add_worksheet", (title,)))
+
+    def del_worksheet(self, ws):
+        self._call(None, "del_worksheet", (ws.title,))
+
+
+class LocalClient:
+    """
+    client واحد في الـprocess: كل الجلسات (و كل AppTest) يشوفو نفس الـspreadsheets
+    (و مع LOCAL_SHEETS_ADDRESS: نفس الـspreadsheets متاع الـserver)
+    """
+
+    _spreadsheets: dict = {}
+    _lock = threading.Lock()
+
+    def open_by_key(self, key: str):
+        with self._lock:
+            if key not in self._spreadsheets:
+                address = os.environ.get("LOCAL_SHEETS_ADDRESS")
+                if address:
+                    self._spreadsheets[key] = RemoteSpreadsheet(key, address)
+                else:
+                    latency = float(os.environ.get("LOCAL_SHEETS_LATENCY_MS", "0") or 0) / 1000
+                    self._spreadsheets[key] = LocalSpreadsheet(key, latency)
+            return self._spreadsheets[key]
+
+
+def local_spreadsheet(key: str = LOCAL_SHEET_ID) -> LocalSpreadsheet:
+    return LocalClient().open_by_key(key)